@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Pipeline benchmark: serves a synthetic repository from a local stand-in for gitiles and the SDK site (see standin.py),
+times every stage of the pipeline on its own and a complete cold nsaptr.py run, and compares the medians against a
+stored baseline.
+"""
+import hashlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+from argparse import ArgumentParser
+from base64 import b64decode
+from urllib import request
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_ROOT)
+
+from benchmarks.standin import CONSTANTS_NAME, LICENSE_ID, StandInServer, build_tree  # noqa: E402
+from util.download import DEFAULT_CHUNK_SIZE, download_archive  # noqa: E402
+from util.repository import parse_repository  # noqa: E402
+from util.requests import fetch, make_request  # noqa: E402
+from util.sdkconstants import parse_constants  # noqa: E402
+from util.zipfile_extract_perms import ZipFileMod, PERMS_PRESERVE_SAFE  # noqa: E402
+
+RESULTS_VERSION = 1
+DEFAULT_TOLERANCE = 0.2
+# runs nsaptr.py with gitiles pointed at the stand-in; argv: repository root, gitiles URL, nsaptr.py, its arguments
+END_TO_END_BOOTSTRAP = '\n'.join([
+    'import runpy, sys',
+    'sys.path.insert(0, sys.argv[1])',
+    'import util.source',
+    'util.source.GITILES_REPOSITORY_URL = sys.argv[2]',
+    'sys.argv = sys.argv[3:]',
+    'runpy.run_path(sys.argv[0], run_name="__main__")',
+])
+# PyXB refuses to build a second schema for a namespace it already knows, so every schema run gets its own process;
+# argv: repository root, XSD, repository XML, its URL. Prints the generation and validation times as JSON.
+SCHEMA_SCRIPT = '\n'.join([
+    'import json, sys, time',
+    'sys.path.insert(0, sys.argv[1])',
+    'from util.bindings import generate_binding_source',
+    'import pyxb.binding.generate',
+    'xsd_data = open(sys.argv[2]).read()',
+    'repository_data = open(sys.argv[3], "rb").read()',
+    'started = time.perf_counter()',
+    'code = compile(generate_binding_source(xsd_data), sys.argv[2], "exec")',
+    'generated = time.perf_counter()',
+    'module = dict()',
+    'exec(code, module)',
+    'loaded = time.perf_counter()',
+    'module["CreateFromDocument"](xml_text=repository_data, location_base=sys.argv[4])',
+    'validated = time.perf_counter()',
+    'print(json.dumps({"binding_generation": generated - started, "validation": validated - loaded}))',
+])
+
+
+def measure(stage: typing.Callable[[], typing.Tuple[int, float]], runs: int) -> dict:
+    """
+    Collects repeated runs of a stage
+    :param stage: callable doing one run of the stage and returning the bytes it processed and the seconds it took
+    :param runs: int - number of runs
+    :return: {'runs', 'min', 'median', 'max', 'bytes', 'throughput'}; times in seconds, throughput in bytes per second
+    """
+    timings = []
+    nbytes = 0
+    for _ in range(runs):
+        nbytes, elapsed = stage()
+        timings.append(elapsed)
+    median = statistics.median(timings)
+    return {
+        'runs': runs,
+        'min': min(timings),
+        'median': median,
+        'max': max(timings),
+        'bytes': nbytes,
+        'throughput': nbytes / median if nbytes and median > 0 else None,
+    }
+
+
+class Pipeline(object):
+    """
+    The stages of an installation, each runnable on its own against the stand-in
+    """
+    def __init__(self, work_dir: str, tree: dict, segments: int, workers: int):
+        self.work_dir = work_dir
+        self.tree = tree
+        self.segments = segments
+        self.workers = workers
+        self.opener, _ = make_request(url=tree['gitiles_url'], method='GET')
+        self.settings = self.metadata_settings()
+        self.repository_url = self.settings['URL_GOOGLE_SDK_SITE'] + \
+            self.settings['URL_FILENAME_PATTERN'].format(int(self.settings['NS_LATEST_VERSION']))
+        self.archive_url = self.tree['site_url'] + os.path.basename(self.tree['archive_path'])
+        with open(tree['repository_path'], 'rb') as fp:
+            self.repository_data = fp.read()
+        with ZipFileMod(tree['archive_path']) as archive:
+            self.inflated_size = sum(x.file_size for x in archive.infolist())
+        self.sequence = 0
+        self.phases = None
+
+    def scratch(self, prefix: str) -> str:
+        self.sequence += 1
+        return os.path.join(self.work_dir, '{}-{}'.format(prefix, self.sequence))
+
+    def metadata_settings(self) -> dict:
+        return parse_constants(b64decode(fetch(self.opener, self.tree['gitiles_url'] + CONSTANTS_NAME +
+                                               '?format=TEXT', cacheable=False)).decode('utf-8'))
+
+    def metadata(self) -> typing.Tuple[int, float]:
+        started = time.perf_counter()
+        data = fetch(self.opener, self.tree['gitiles_url'] + CONSTANTS_NAME + '?format=TEXT', cacheable=False)
+        parse_constants(b64decode(data).decode('utf-8'))
+        return len(data), time.perf_counter() - started
+
+    def _schema(self, phase: str) -> float:
+        result = subprocess.run([sys.executable, '-c', SCHEMA_SCRIPT, REPOSITORY_ROOT, self.tree['xsd_path'],
+                                 self.tree['repository_path'], self.repository_url],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise RuntimeError('Schema run failed:\n{}'.format(result.stderr.decode('utf-8', 'replace')))
+        return json.loads(result.stdout.decode('utf-8').splitlines()[-1])[phase]
+
+    def binding_generation(self) -> typing.Tuple[int, float]:
+        return os.path.getsize(self.tree['xsd_path']), self._schema('binding_generation')
+
+    def validation(self) -> typing.Tuple[int, float]:
+        return len(self.repository_data), self._schema('validation')
+
+    def parse(self) -> typing.Tuple[int, float]:
+        started = time.perf_counter()
+        data = fetch(self.opener, self.repository_url, cacheable=False)
+        platform_tools, licenses = parse_repository(data, xmlns=self.settings['XMLNS'],
+                                                    root_name=self.settings['NODE_SDK_REPOSITORY'],
+                                                    node_name=self.settings['NODE_PLATFORM_TOOL'])
+        elapsed = time.perf_counter() - started
+        assert platform_tools and LICENSE_ID in licenses
+        return len(data), elapsed
+
+    def download(self) -> typing.Tuple[int, float]:
+        req = request.Request(self.archive_url, method='GET')
+        started = time.perf_counter()
+        with download_archive(self.opener, req, size=self.tree['archive_size'], checksum_type='sha1',
+                              checksum_value=self.tree['archive_sha1']):
+            pass
+        return self.tree['archive_size'], time.perf_counter() - started
+
+    def download_segmented(self) -> typing.Tuple[int, float]:
+        req = request.Request(self.archive_url, method='GET')
+        download_dir = self.scratch('download')
+        started = time.perf_counter()
+        with download_archive(self.opener, req, size=self.tree['archive_size'], checksum_type='sha1',
+                              checksum_value=self.tree['archive_sha1'], download_dir=download_dir,
+                              segments=self.segments,
+                              min_segment_size=max(self.tree['archive_size'] // self.segments, 1)):
+            pass
+        elapsed = time.perf_counter() - started
+        shutil.rmtree(download_dir)
+        return self.tree['archive_size'], elapsed
+
+    def hashing(self) -> typing.Tuple[int, float]:
+        hasher = hashlib.sha1()
+        started = time.perf_counter()
+        with open(self.tree['archive_path'], 'rb') as fp:
+            for chunk in iter(lambda: fp.read(DEFAULT_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        elapsed = time.perf_counter() - started
+        assert hasher.hexdigest() == self.tree['archive_sha1']
+        return self.tree['archive_size'], elapsed
+
+    def _extract(self, workers: int) -> typing.Tuple[int, float]:
+        target_dir = self.scratch('extract')
+        started = time.perf_counter()
+        with ZipFileMod(self.tree['archive_path']) as archive:
+            archive.extractall(path=target_dir, preserve_permissions=PERMS_PRESERVE_SAFE, workers=workers)
+        elapsed = time.perf_counter() - started
+        shutil.rmtree(target_dir)
+        return self.inflated_size, elapsed
+
+    def extract(self) -> typing.Tuple[int, float]:
+        return self._extract(1)
+
+    def extract_parallel(self) -> typing.Tuple[int, float]:
+        return self._extract(self.workers)
+
+    def end_to_end(self) -> typing.Tuple[int, float]:
+        """
+        Runs nsaptr.py the way a first installation on a fresh machine would, nothing cached
+        The per-phase record nsaptr.py writes with --timings is kept in self.phases
+        """
+        run_dir = self.scratch('end-to-end')
+        home = os.path.join(run_dir, 'home')
+        os.makedirs(home)
+        with open(os.path.join(run_dir, 'nsaptr.conf'), 'w') as fp:
+            fp.write('[config]\n'
+                     'cache_dir = {}\n'
+                     'validate_repository = True\n'
+                     'extraction_workers = {}\n'
+                     'download_segments = {}\n'.format(os.path.join(run_dir, 'cache'), self.workers, self.segments))
+        timings_path = os.path.join(run_dir, 'timings.json')
+        environment = dict(os.environ)
+        environment['HOME'] = home
+        command = [sys.executable, '-c', END_TO_END_BOOTSTRAP, REPOSITORY_ROOT, self.tree['gitiles_url'],
+                   os.path.join(REPOSITORY_ROOT, 'nsaptr.py'), '--batch', '--version', 'latest',
+                   '--dest', os.path.join(run_dir, 'install'), '--accept-license', self.tree['license_sha1'],
+                   '--timings', timings_path]
+        started = time.perf_counter()
+        result = subprocess.run(command, cwd=run_dir, env=environment, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        elapsed = time.perf_counter() - started
+        if result.returncode != 0:
+            raise RuntimeError('nsaptr.py exited with status {}:\n{}'.format(
+                result.returncode, result.stdout.decode('utf-8', 'replace')))
+        with open(timings_path, 'r') as fp:
+            self.phases = json.loads(fp.readline())['phases']
+        shutil.rmtree(run_dir)
+        return self.tree['archive_size'], elapsed
+
+
+STAGES = ('metadata', 'binding_generation', 'validation', 'parse', 'download', 'download_segmented', 'hashing',
+          'extract', 'extract_parallel', 'end_to_end')
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> typing.List[str]:
+    """
+    Lists the stages whose median got slower than the baseline allows
+    :param results: dict - results of this run
+    :param baseline: dict - results of an earlier run
+    :param tolerance: float - allowed slowdown, 0.2 meaning 20 %
+    :return: names of the stages that regressed
+    """
+    regressions = []
+    for name, stage in results['stages'].items():
+        reference = baseline.get('stages', {}).get(name)
+        if reference is None or reference['median'] <= 0:
+            continue
+        stage['baseline_median'] = reference['median']
+        stage['ratio'] = stage['median'] / reference['median']
+        if stage['ratio'] > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> int:
+    parser = ArgumentParser(description='Measure every stage of the pipeline against a local repository stand-in')
+    parser.add_argument('--versions', type=int, default=500,
+                        help='platform-tool entries in the repository XML (default: %(default)s)')
+    parser.add_argument('--archive-size', type=int, default=32 * 1024 * 1024,
+                        help='uncompressed archive size in bytes (default: %(default)s)')
+    parser.add_argument('--members', type=int, default=200,
+                        help='number of files in the archive (default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=5, help='timed runs per stage (default: %(default)s)')
+    parser.add_argument('--segments', type=int, default=4,
+                        help='Range connections for segmented downloads (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='extraction workers for the parallel stages (default: %(default)s)')
+    parser.add_argument('--stage', action='append', choices=STAGES, default=None,
+                        help='only run this stage; may be repeated')
+    parser.add_argument('--output', metavar='FILE', default=None, help='store the results as JSON in FILE')
+    parser.add_argument('--baseline', metavar='FILE', default=None,
+                        help='compare against results stored earlier with --output')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed slowdown against the baseline before a stage counts as a regression '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    parameters = {
+        'versions': args.versions,
+        'archive_size': args.archive_size,
+        'members': args.members,
+        'segments': args.segments,
+        'workers': args.workers,
+    }
+    results = {
+        'results_version': RESULTS_VERSION,
+        'created_at': time.time(),
+        'platform': platform.system(),
+        'python': platform.python_version(),
+        'parameters': parameters,
+        'stages': dict(),
+    }
+    with tempfile.TemporaryDirectory(prefix='nsaptr-pipeline-') as work_dir:
+        serve_dir = os.path.join(work_dir, 'serve')
+        os.makedirs(serve_dir)
+        server = StandInServer(serve_dir).start()
+        try:
+            tree = build_tree(serve_dir, server.base_url, args.versions, args.archive_size, args.members)
+            pipeline = Pipeline(os.path.join(work_dir, 'scratch'), tree, args.segments, args.workers)
+            for name in args.stage or STAGES:
+                results['stages'][name] = measure(getattr(pipeline, name), args.runs)
+                if name == 'end_to_end':
+                    results['stages'][name]['phases'] = pipeline.phases
+        finally:
+            server.stop()
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+        if baseline.get('parameters') != parameters:
+            print('warning: the baseline was recorded with different parameters: {}'.format(
+                baseline.get('parameters')))
+        regressions = compare(results, baseline, args.tolerance)
+
+    print('{:<20} {:>10} {:>10} {:>10} {:>12} {:>9}'.format('stage', 'min', 'median', 'max', 'MB/s', 'baseline'))
+    for name, stage in results['stages'].items():
+        print('{:<20} {:>9.4f}s {:>9.4f}s {:>9.4f}s {:>12} {:>9}'.format(
+            name, stage['min'], stage['median'], stage['max'],
+            '{:.1f}'.format(stage['throughput'] / 1e6) if stage['throughput'] else '-',
+            '{:+.0%}'.format(stage['ratio'] - 1) if 'ratio' in stage else '-'))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if regressions:
+        print('regressed beyond {:.0%}: {}'.format(args.tolerance, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,330 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Local stand-in for gitiles and dl.google.com: a synthetic SdkRepoConstants.java and XSD served base64-encoded on
+"?format=TEXT" like gitiles does, and a repository XML with generated ZIP archives served with ETags, Last-Modified
+and byte ranges like the SDK site.
+"""
+import hashlib
+import os
+import random
+import re
+import threading
+import typing
+import zipfile
+from base64 import b64encode
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+from util.mirror import CONSTANTS_NAME
+
+GITILES_PATH = '/gitiles/'
+SITE_PATH = '/android/repository/'
+NS_LATEST_VERSION = 11
+NS_URI = 'http://schemas.android.com/sdk/android/repository/{}'.format(NS_LATEST_VERSION)
+LICENSE_ID = 'android-sdk-license'
+LICENSE_TEXT = 'Terms and conditions of the synthetic benchmark repository.'
+ARCHIVE_NAME = 'platform-tools_synthetic.zip'
+XSD_NAME = 'sdk-repository-{}.xsd'.format(NS_LATEST_VERSION)
+REPOSITORY_NAME = 'repository-{}.xml'.format(NS_LATEST_VERSION)
+HOST_OSES = ('linux', 'macosx', 'windows')
+
+CONSTANTS_TEMPLATE = '''package com.android.sdklib.repository;
+
+public class SdkRepoConstants extends RepoConstants {{
+    public static final String URL_GOOGLE_SDK_SITE =
+        "{site_url}";                      //$NON-NLS-1$
+    public static final int NS_LATEST_VERSION = {latest};
+    public static final String URL_FILENAME_PATTERN = "repository-%1$d.xml";      //$NON-NLS-1$
+    private static final String NS_BASE =
+        "http://schemas.android.com/sdk/android/repository/";           //$NON-NLS-1$
+    public static final String NS_PATTERN = NS_BASE + "([0-9]+)";     //$NON-NLS-1$
+    public static final String NS_URI = getSchemaUri(NS_LATEST_VERSION);
+    public static final String NODE_SDK_REPOSITORY = "sdk-repository";   //$NON-NLS-1$
+    public static final String NODE_PLATFORM_TOOL = "platform-tool";     //$NON-NLS-1$
+    public static String getSchemaUri(int version) {{
+        return String.format(NS_BASE + "%d", version);           //$NON-NLS-1$
+    }}
+}}
+'''
+
+XSD_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:sdk="{ns}" targetNamespace="{ns}"
+            elementFormDefault="qualified" attributeFormDefault="unqualified" version="1">
+    <xsd:element name="sdk-repository">
+        <xsd:complexType>
+            <xsd:choice minOccurs="0" maxOccurs="unbounded">
+                <xsd:element name="platform-tool" type="sdk:platformToolType"/>
+                <xsd:element name="license" type="sdk:licenseType"/>
+            </xsd:choice>
+        </xsd:complexType>
+    </xsd:element>
+    <xsd:complexType name="licenseType">
+        <xsd:simpleContent>
+            <xsd:extension base="xsd:string">
+                <xsd:attribute name="id" type="xsd:ID" use="required"/>
+                <xsd:attribute name="type" type="xsd:token" fixed="text"/>
+            </xsd:extension>
+        </xsd:simpleContent>
+    </xsd:complexType>
+    <xsd:complexType name="revisionType">
+        <xsd:sequence>
+            <xsd:element name="major" type="xsd:int"/>
+            <xsd:element name="minor" type="xsd:int" minOccurs="0"/>
+            <xsd:element name="micro" type="xsd:int" minOccurs="0"/>
+        </xsd:sequence>
+    </xsd:complexType>
+    <xsd:simpleType name="checksumTypeType">
+        <xsd:restriction base="xsd:token">
+            <xsd:enumeration value="sha1"/>
+        </xsd:restriction>
+    </xsd:simpleType>
+    <xsd:complexType name="checksumType">
+        <xsd:simpleContent>
+            <xsd:extension base="xsd:string">
+                <xsd:attribute name="type" type="sdk:checksumTypeType" use="required"/>
+            </xsd:extension>
+        </xsd:simpleContent>
+    </xsd:complexType>
+    <xsd:simpleType name="osType">
+        <xsd:restriction base="xsd:token">
+            <xsd:enumeration value="linux"/>
+            <xsd:enumeration value="macosx"/>
+            <xsd:enumeration value="windows"/>
+        </xsd:restriction>
+    </xsd:simpleType>
+    <xsd:complexType name="archiveType">
+        <xsd:sequence>
+            <xsd:element name="size" type="xsd:long"/>
+            <xsd:element name="checksum" type="sdk:checksumType"/>
+            <xsd:element name="url" type="xsd:token"/>
+            <xsd:element name="host-os" type="sdk:osType" minOccurs="0"/>
+        </xsd:sequence>
+    </xsd:complexType>
+    <xsd:complexType name="archivesType">
+        <xsd:sequence>
+            <xsd:element name="archive" type="sdk:archiveType" maxOccurs="unbounded"/>
+        </xsd:sequence>
+    </xsd:complexType>
+    <xsd:complexType name="usesLicenseType">
+        <xsd:attribute name="ref" type="xsd:IDREF" use="required"/>
+    </xsd:complexType>
+    <xsd:complexType name="platformToolType">
+        <xsd:sequence>
+            <xsd:element name="revision" type="sdk:revisionType"/>
+            <xsd:element name="archives" type="sdk:archivesType"/>
+            <xsd:element name="uses-license" type="sdk:usesLicenseType" minOccurs="0"/>
+        </xsd:sequence>
+    </xsd:complexType>
+</xsd:schema>
+'''
+
+
+def make_archive(path: str, size: int, members: int, seed: int = 0) -> None:
+    """
+    Writes a deflated ZIP archive laid out like a platform-tools release
+    Half of every member is random (incompressible), the other half repetitive, so inflating does real work
+    :param path: str - archive to create
+    :param size: int - total uncompressed size of the members in bytes
+    :param members: int - number of file members
+    :param seed: int - seed for the random contents
+    :rtype: None
+    """
+    rng = random.Random(seed)
+    member_size = max(size // max(members, 1), 1)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('platform-tools/', b'')
+        for index in range(members):
+            info = zipfile.ZipInfo('platform-tools/{}/file{:05d}.bin'.format('lib' if index % 2 else 'bin', index))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = (0o755 if index % 2 == 0 else 0o644) << 16
+            random_part = rng.getrandbits(8 * (member_size // 2)).to_bytes(member_size // 2, 'little') \
+                if member_size >= 2 else b''
+            filler = (b'platform-tools %d ' % index) * (member_size // 16 + 1)
+            archive.writestr(info, random_part + filler[:member_size - len(random_part)])
+
+
+def _hash_file(path: str) -> str:
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def build_tree(root: str, base_url: str, versions: int, archive_size: int, members: int) -> dict:
+    """
+    Lays out the files served by the stand-in
+    Every version lists the same archive for every host OS, so the tree stays small however many versions there are
+    :param root: str - empty directory to fill
+    :param base_url: str - URL the server will be reachable at, without a trailing slash
+    :param versions: int - number of platform-tool entries in the repository XML
+    :param archive_size: int - uncompressed archive size in bytes
+    :param members: int - number of files in the archive
+    :return: {'gitiles_url', 'site_url', 'license_sha1', 'archive_path', 'archive_size', 'archive_sha1',
+        'repository_path', 'xsd_path', 'latest_version'}
+    """
+    gitiles_dir = os.path.join(root, *GITILES_PATH.strip('/').split('/'))
+    site_dir = os.path.join(root, *SITE_PATH.strip('/').split('/'))
+    os.makedirs(gitiles_dir)
+    os.makedirs(site_dir)
+    site_url = base_url + SITE_PATH
+    with open(os.path.join(gitiles_dir, CONSTANTS_NAME), 'w') as fp:
+        fp.write(CONSTANTS_TEMPLATE.format(site_url=site_url, latest=NS_LATEST_VERSION))
+    xsd_path = os.path.join(gitiles_dir, XSD_NAME)
+    with open(xsd_path, 'w') as fp:
+        fp.write(XSD_TEMPLATE.format(ns=NS_URI))
+
+    archive_path = os.path.join(site_dir, ARCHIVE_NAME)
+    make_archive(archive_path, archive_size, members)
+    archive_sha1 = _hash_file(archive_path)
+    archive_entries = ''.join(
+        '<sdk:archive><sdk:size>{}</sdk:size><sdk:checksum type="sha1">{}</sdk:checksum>'
+        '<sdk:url>{}</sdk:url><sdk:host-os>{}</sdk:host-os></sdk:archive>'.format(
+            os.path.getsize(archive_path), archive_sha1, ARCHIVE_NAME, host_os)
+        for host_os in HOST_OSES)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<sdk:sdk-repository xmlns:sdk="{}">'.format(NS_URI),
+             '<sdk:license id="{}" type="text">{}</sdk:license>'.format(LICENSE_ID, LICENSE_TEXT)]
+    numbers = []
+    for index in range(versions):
+        major, minor, micro = 1 + index // 100, (index // 10) % 10, index % 10
+        numbers.append((major, minor, micro))
+        lines.append('<sdk:platform-tool><sdk:revision><sdk:major>{}</sdk:major><sdk:minor>{}</sdk:minor>'
+                     '<sdk:micro>{}</sdk:micro></sdk:revision><sdk:archives>{}</sdk:archives>'
+                     '<sdk:uses-license ref="{}"/></sdk:platform-tool>'.format(major, minor, micro, archive_entries,
+                                                                               LICENSE_ID))
+    lines.append('</sdk:sdk-repository>')
+    repository_path = os.path.join(site_dir, REPOSITORY_NAME)
+    with open(repository_path, 'w') as fp:
+        fp.write('\n'.join(lines))
+    return {
+        'gitiles_url': base_url + GITILES_PATH,
+        'site_url': site_url,
+        'license_sha1': hashlib.sha1(LICENSE_TEXT.encode('utf-8')).hexdigest(),
+        'archive_path': archive_path,
+        'archive_size': os.path.getsize(archive_path),
+        'archive_sha1': archive_sha1,
+        'repository_path': repository_path,
+        'xsd_path': xsd_path,
+        'latest_version': '{}.{}.{}'.format(*max(numbers)),
+    }
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves the tree of the server it belongs to; HTTP/1.1 so that keep-alive connections are exercised
+    """
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes; without this delayed ACKs stall every small response
+    disable_nagle_algorithm = True
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def _serve(self, send_body: bool) -> None:
+        url = parse.urlsplit(self.path)
+        parts = [x for x in parse.unquote(url.path).split('/') if x not in ('', '.', '..')]
+        path = os.path.join(self.server.root, *parts)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        stat = os.stat(path)
+        etag = '"{:x}-{:x}"'.format(stat.st_size, stat.st_mtime_ns)
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        if self.headers.get('If-None-Match') == etag or self.headers.get('If-Modified-Since') == last_modified:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return
+        with open(path, 'rb') as fp:
+            if parse.parse_qs(url.query).get('format') == ['TEXT']:
+                self._send(200, b64encode(fp.read()), etag, last_modified, send_body)
+                return
+            first, last = 0, stat.st_size - 1
+            status = 200
+            match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+            if_range = self.headers.get('If-Range')
+            if match and (if_range is None or if_range in (etag, last_modified)) and any(match.groups()):
+                if match.group(1):
+                    first = int(match.group(1))
+                    last = min(int(match.group(2)), last) if match.group(2) else last
+                else:
+                    first = max(stat.st_size - int(match.group(2)), 0)
+                if first > last:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{}'.format(stat.st_size))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(last - first + 1))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Accept-Ranges', 'bytes')
+            if status == 206:
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, last, stat.st_size))
+            self.end_headers()
+            if not send_body:
+                return
+            fp.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                chunk = fp.read(min(remaining, 256 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def _send(self, status: int, body: bytes, etag: str, last_modified: str, send_body: bool) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root: str, address: typing.Tuple[str, int] = ('127.0.0.1', 0)):
+        self.root = root
+        super().__init__(address, StandInHandler)
+
+    @property
+    def base_url(self) -> str:
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def start(self) -> 'StandInServer':
+        threading.Thread(target=self.serve_forever, name='standin-server', daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
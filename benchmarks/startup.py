@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Startup-time regression check: times complete nsaptr.py runs that find nothing to do (an intact installation and a
+recent repository snapshot listing nothing newer) and fails if the median exceeds the budget.
+"""
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_ROOT)
+
+from util.manifest import write_manifest, write_snapshot  # noqa: E402
+
+DEFAULT_BUDGET = 0.15
+PLATFORMS = {
+    'Linux': 'linux',
+    'Windows': 'windows',
+    'Darwin': 'macosx',
+}
+
+
+def prepare(work_dir: str) -> dict:
+    """
+    Lays out a home directory, a configuration and an installation with nothing left to do
+    :param work_dir: str - empty scratch directory
+    :return: environment to run nsaptr.py with
+    """
+    home = os.path.join(work_dir, 'home')
+    cache_dir = os.path.join(work_dir, 'cache')
+    install_dir = os.path.join(work_dir, 'install')
+    for directory in (home, cache_dir, install_dir):
+        os.makedirs(directory)
+    checksum = {'type': 'sha1', 'value': '0' * 40}
+    with open(os.path.join(install_dir, 'adb'), 'wb') as fp:
+        fp.write(b'adb')
+    write_manifest(install_dir, version='24.0.1', checksum=checksum, license_id='android-sdk-license',
+                   files={'adb': {'size': 3, 'crc32': 0}})
+    write_snapshot(cache_dir, PLATFORMS[platform.system()],
+                   {'24.0.1': {'checksum': checksum, 'license': 'android-sdk-license'}})
+    with open(os.path.join(work_dir, 'nsaptr.conf'), 'w') as fp:
+        fp.write('[config]\n'
+                 'cache_dir = {}\n'
+                 'do_not_ask_again = True\n'
+                 'extraction_targets = {}\n'.format(cache_dir, install_dir))
+    environment = dict(os.environ)
+    environment['HOME'] = home
+    return environment
+
+
+def main() -> int:
+    parser = ArgumentParser(description='Measure the cold start of a run that has nothing to do')
+    parser.add_argument('--runs', type=int, default=10, help='number of timed runs (default: %(default)s)')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET,
+                        help='maximum median wall time in seconds (default: %(default)s)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='nsaptr-startup-') as work_dir:
+        environment = prepare(work_dir)
+        command = [sys.executable, os.path.join(REPOSITORY_ROOT, 'nsaptr.py')]
+        timings = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            result = subprocess.run(command, cwd=work_dir, env=environment, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            timings.append(time.perf_counter() - started)
+            if result.returncode != 0:
+                print(result.stdout.decode('utf-8', 'replace'))
+                print('nsaptr.py exited with status {}; expected a no-op run'.format(result.returncode))
+                return 2
+
+    median = statistics.median(timings)
+    print('runs: {}  min: {:.3f}s  median: {:.3f}s  max: {:.3f}s  budget: {:.3f}s'.format(
+        len(timings), min(timings), median, max(timings), args.budget))
+    return 0 if median <= args.budget else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
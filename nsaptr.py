@@ -15,40 +15,88 @@ Copyright 2016 adpoliak
    See the License for the specific language governing permissions and
    limitations under the License.
 """
-# from argparse import ArgumentParser
-import logging
-import re
-from base64 import b64decode, b64encode
+# only what a run with nothing to do needs is imported up front; everything else is imported once there is work
+import atexit
+import sys
+import typing
+from argparse import ArgumentParser
 from configparser import ConfigParser
-from distutils.version import LooseVersion
-from hashlib import sha1
-from io import BytesIO
-from os.path import expanduser, isdir
+from os import environ
+from os.path import expanduser, isdir, join
 from platform import system
-from types import ModuleType
-from pyxb.binding import generate
-from util.javafmtstr import pythonify_java_format_string, java_format_string_regex
-from util.requests import make_request, reset_request
-from util.zipfile_extract_perms import ZipFileMod as ZipFile, PERMS_PRESERVE_SAFE
-
-# noinspection PyBroadException
-try:
-    import tkinter as tk
-    root = tk.Tk()
-    root.withdraw()
-except:
-    has_window_manager = False
-    from textwrap import fill
-    from ui.curses.askdirectory import askdirectory
-else:
-    has_window_manager = True
-    from tkinter.filedialog import askdirectory
-    from ui.tkinter.versionchooser import VersionChoiceDialog
-    from ui.tkinter.licensedialog import LicenseDialog
+from util.manifest import is_up_to_date, manifest_intact, read_manifest, read_snapshot
+from util.staging import CURRENT_LINK, rollback
+from util.timings import timings
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+EXIT_LICENSE_NOT_ACCEPTED = 3
+EXIT_VERSION_UNAVAILABLE = 4
+EXIT_DOWNLOAD_FAILED = 5
+EXIT_INSTALL_FAILED = 6
+EXIT_CANCELLED = 7
+
+
+def fail(code: int, message: str) -> typing.NoReturn:
+    print(message, file=sys.stderr)
+    sys.exit(code)
+
+
+parser = ArgumentParser(description='Non-Sketchy Android Platform Tools Retriever',
+                        epilog='exit status: {} success or nothing to do, {} unexpected error, {} usage error, '
+                               '{} license not accepted, {} version not available, {} download failed, '
+                               '{} installation failed, {} cancelled by the user'.format(
+                                   EXIT_OK, EXIT_ERROR, EXIT_USAGE, EXIT_LICENSE_NOT_ACCEPTED,
+                                   EXIT_VERSION_UNAVAILABLE, EXIT_DOWNLOAD_FAILED, EXIT_INSTALL_FAILED,
+                                   EXIT_CANCELLED))
+parser.add_argument('--batch', action='store_true',
+                    help='never prompt: decisions not given on the command line or in the configuration are errors')
+parser.add_argument('--version', metavar='VERSION', default=None,
+                    help="version to install: 'latest', 'keep' (the installed version while it is still available, "
+                         "the latest otherwise) or an exact version such as 24.0.1")
+parser.add_argument('--dest', metavar='DIR', action='append', default=None,
+                    help='base directory to install into; may be repeated; overrides extraction_targets')
+parser.add_argument('--accept-license', metavar='SHA1', action='append', default=[],
+                    help='accept the license text with this SHA-1 without asking; may be repeated')
+parser.add_argument('--rollback', action='store_true',
+                    help='re-activate the previously installed version in each destination (staged installs), '
+                         'then exit')
+parser.add_argument('--mirror', metavar='DIR', default=None,
+                    help='synchronise the archives of every version for every host OS, along with the repository '
+                         'metadata, into a local mirror of the SDK site, then exit')
+parser.add_argument('--source', metavar='LOCATION', default=None,
+                    help='read the repository from a mirror (directory, file:// or http(s):// URL) instead of '
+                         "Google's servers; overrides repository_source from the configuration")
+parser.add_argument('--timings', metavar='FILE', nargs='?', const='-', default=None,
+                    help='append a JSON record of per-phase wall time, CPU time and bytes, request counts and cache '
+                         'hits / misses to FILE when the run ends (stderr if FILE is omitted or -)')
+args = parser.parse_args()
+if args.timings is not None:
+    timings.enabled = True
+    atexit.register(timings.write, args.timings)
 
 config_defaults = {
     'config': {
         'accepted_license_sha1': None,
+        'cache_dir': '~/.cache/nsaptr',
+        'download_segments': 1,
+        'download_min_segment_size': 4 * 1024 * 1024,
+        'validate_repository': False,
+        'extraction_workers': 4,
+        'incremental_upgrade': True,
+        'metadata_max_age': 3600,
+        'staged_install': False,
+        'keep_versions': 2,
+        'pipelined_extraction': False,
+        'archive_cache_size': 1024 * 1024 * 1024,
+        'extraction_targets': None,
+        'shared_extraction': False,
+        'link_methods': 'reflink,hardlink,copy',
+        'shared_extraction_keep': 3,
+        'mirror_workers': 4,
+        'repository_source': None,
+        'bootstrap_ttl': 7 * 24 * 3600,
         'persist_choices': False,
         'keep_while_available': False,
         'do_not_ask_again': False,
@@ -73,130 +121,280 @@ config.read([
 ])
 if not isdir(config['last_run']['extraction_base_dir']):
     config['last_run']['extraction_base_dir'] = '.'
+# [config] keys answered by the user during this run; only these and [last_run] are saved to ~/.nsaptr.conf, so the
+# defaults and whatever the other configuration files say are never frozen into it
+chosen_settings = set()
+cache_dir = expanduser(config['config']['cache_dir']) if config['config']['cache_dir'] else None
+staged_install = config['config'].getboolean('staged_install')
+# comma-separated list of base directories to install into instead of asking for one
+extraction_targets = [expanduser(x.strip()) for x in (config['config']['extraction_targets'] or '').split(',')
+                      if x.strip()]
+if args.dest:
+    extraction_targets = [expanduser(x) for x in args.dest]
+if args.batch and not extraction_targets and not args.mirror:
+    fail(EXIT_USAGE, 'Batch mode needs --dest or extraction_targets in the configuration')
+
+if args.rollback:
+    rollback_failed = False
+    for rollback_dir in extraction_targets or [config['last_run']['extraction_base_dir']]:
+        try:
+            print('{}: rolled back to {}'.format(rollback_dir, rollback(rollback_dir)))
+        except OSError as e:
+            rollback_failed = True
+            print('{}: rollback failed: {}'.format(rollback_dir, e), file=sys.stderr)
+    sys.exit(EXIT_INSTALL_FAILED if rollback_failed else EXIT_OK)
+
+
+def installed_root(base_dir: str) -> str:
+    return join(base_dir, CURRENT_LINK) if staged_install else base_dir
+
+
+platforms = {
+    'Linux': 'linux',
+    'Windows': 'windows',
+    'Darwin': 'macosx',
+}
 
+
+def target_up_to_date(base_dir: str, snapshot: dict) -> bool:
+    installed_manifest = read_manifest(installed_root(base_dir))
+    if installed_manifest is None:
+        return False
+    if args.version is None:
+        keep_installed = config['config'].getboolean('keep_while_available')
+    elif args.version in ('latest', 'keep'):
+        keep_installed = args.version == 'keep'
+    else:
+        # an exact version is good enough as long as it is the one installed and still published
+        keep_installed = installed_manifest.get('version') == args.version
+        if not keep_installed:
+            return False
+    return is_up_to_date(installed_manifest, snapshot, keep_installed) and \
+        manifest_intact(installed_root(base_dir), installed_manifest)
+
+
+# nothing to do if the last installs are intact and a recent repository snapshot has nothing newer to offer; only
+# runs that will not ask which version to install can tell this up front
+if cache_dir and (config['config'].getboolean('do_not_ask_again') or args.version is not None or args.batch) and \
+        not args.mirror:
+    repository_snapshot = read_snapshot(cache_dir, platforms[system()], config['config'].getfloat('metadata_max_age'))
+    if repository_snapshot is not None and \
+            all(target_up_to_date(x, repository_snapshot)
+                for x in extraction_targets or [config['last_run']['extraction_base_dir']]):
+        sys.exit(EXIT_OK)
+
+import logging  # noqa: E402
+import re  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+from hashlib import sha1  # noqa: E402
+from http.client import HTTPException  # noqa: E402
+from io import StringIO  # noqa: E402
+from os import makedirs  # noqa: E402
+from shutil import rmtree  # noqa: E402
+from time import time  # noqa: E402
+from types import ModuleType  # noqa: E402
+from util.archivestore import ArchiveStore  # noqa: E402
+from util.bindings import load_binding_module  # noqa: E402
+from util.download import download_archive  # noqa: E402
+from util.extractedstore import ExtractedStore  # noqa: E402
+from util.fileutil import atomic_write  # noqa: E402
+from util.manifest import write_manifest, write_snapshot  # noqa: E402
+from util.mirror import CONSTANTS_NAME, mirror_relative_path, sync_mirror  # noqa: E402
+from util.repository import parse_repository  # noqa: E402
+from util.requests import fetch, make_request, reset_request  # noqa: E402
+from util.sdkconstants import parse_constants, read_cached_settings, source_hash, write_cached_settings  # noqa: E402
+from util.source import repository_source  # noqa: E402
+from util.staging import create_stage, prune, publish_stage  # noqa: E402
+from util.versionindex import VersionIndex, version_key  # noqa: E402
+from util.zipfile_extract_perms import ZipFileMod as ZipFile, PERMS_PRESERVE_SAFE, ZipStreamExtractor  # noqa: E402
+
+root = None
+has_window_manager = None
+
+
+def load_ui() -> bool:
+    """
+    Picks the dialogs to use the first time one is needed
+    Tk is only probed where a display may exist; on headless hosts the probe fails, and only slowly
+    :return: whether tkinter dialogs are available (otherwise the curses / text mode ones are used)
+    """
+    global root, has_window_manager, askdirectory, fill, VersionChoiceDialog, LicenseDialog
+    if has_window_manager is not None:
+        return has_window_manager
+    has_window_manager = False
+    if system() in ('Windows', 'Darwin') or environ.get('DISPLAY') or environ.get('WAYLAND_DISPLAY'):
+        # noinspection PyBroadException
+        try:
+            import tkinter as tk
+            root = tk.Tk()
+            root.withdraw()
+        except:
+            pass
+        else:
+            has_window_manager = True
+    if has_window_manager:
+        from tkinter.filedialog import askdirectory
+        from ui.tkinter.versionchooser import VersionChoiceDialog
+        from ui.tkinter.licensedialog import LicenseDialog
+    else:
+        from textwrap import fill
+        from ui.curses.askdirectory import askdirectory
+    return has_window_manager
+
+
+source = repository_source(args.source if args.source is not None else config['config']['repository_source'])
 opener, req = make_request(
-    url='https://android.googlesource.com/platform/tools/base/+/master/sdklib/src/main/java/com/android/sdklib/'
-        'repository/SdkRepoConstants.java?format=TEXT',
+    url=source.constants_url,
     method='GET',
+    cache_dir=join(cache_dir, 'http') if cache_dir else None,
+    cacheable=True,
 )
 
-with opener.open(req) as conn:
-    byte_stream = conn.read()
-    raw_data = b64decode(byte_stream)
-    sdk_repo_source_data = raw_data.decode('utf-8')
-
-
-def make_rxstr() -> str:
-    rxstr = r''
-    sf = r'static[ \t]+final[ \t]+'
-    psf = r'^[ \t]*public[ \t]+' + sf
-    psfs = psf + r'string[ \t]+'
-    rsfs = r'^[ \t]*private[ \t]+' + sf + r'string[ \t]+'
-    endl = r'[ \t]*$'
-    nn1 = r'[ \t]+//\$NON-NLS-1\$' + endl
-    # URL_GOOGLE_SDK_SITE Variable
-    rxstr += psfs + r'URL_GOOGLE_SDK_SITE[ \t\r\n]*=[ \t\r\n]*[\'"](?P<URL_GOOGLE_SDK_SITE>.*?)[\'"];' + nn1 + r'|'
-    # NS_LATEST_VERSION Variable
-    rxstr += psf + r'int[ \t]+NS_LATEST_VERSION[ \t\r\n]*=[ \t\r\n]*(?P<NS_LATEST_VERSION>.*?);' + endl + r'|'
-    # URL_FILENAME_PATTERN Variable
-    rxstr += psfs + r'URL_FILENAME_PATTERN[ \t\r\n]*=[ \t\r\n]*[\'"](?P<URL_FILENAME_PATTERN>.*?)[\'"];' + nn1 + r'|'
-    # NS_BASE Variable
-    rxstr += rsfs + r'NS_BASE[ \t\r\n]*=[ \t\r\n]*[\'"](?P<NS_BASE>.*?)[\'"];' + nn1 + r'|'
-    # NS_PATTERN Variable
-    rxstr += psfs + r'NS_PATTERN[ \t\r\n]*=[ \t\r\n]*(?P<NS_PATTERN>.*?);' + nn1 + r'|'
-    # NS_URI Variable
-    rxstr += psfs + r'NS_URI[ \t\r\n]*=[ \t\r\n]*(?P<NS_URI>.*?);' + endl + r'|'
-    # NODE_SDK_REPOSITORY Variable
-    rxstr += psfs + r'NODE_SDK_REPOSITORY[ \t\r\n]*=[ \t\r\n]*[\'"](?P<NODE_SDK_REPOSITORY>.*?)[\'"];' + nn1 + r'|'
-    # NODE_PLATFORM_TOOL Variable
-    rxstr += psfs + r'NODE_PLATFORM_TOOL[ \t\r\n]*=[ \t\r\n]*[\'"](?P<NODE_PLATFORM_TOOL>.*?)[\'"];' + nn1 + r'|'
-    # GETSCHEMAURI Variable
-    rxstr += r'^[ \t]*(?P<GETSCHEMAURI>public[ \t]+static[ \t]+string[ \t]+getSchemaUri\([^)]*\)[ \t]*\{.*?\})[ \t\r\n]'
-    rxstr += r'*$'
-    return rxstr
-
-
-rx_string = make_rxstr()
-rx = re.compile(rx_string, re.MULTILINE + re.IGNORECASE + re.VERBOSE + re.UNICODE + re.DOTALL)
-
-settings = dict()
-for match in rx.finditer(sdk_repo_source_data):
-    settings.update({key: val for key, val in match.groupdict().items() if val is not None})
-
-if settings['NS_PATTERN'].startswith('NS_BASE + '):
-    settings['NS_PATTERN'] = settings['NS_BASE'] + settings['NS_PATTERN'][10:].replace('"', '')
-
-if b64encode(settings['GETSCHEMAURI'].encode('utf-8')) == (b'cHVibGljIHN0YXRpYyBTdHJpbmcgZ2V0U2NoZW1hVXJpKGludCB2ZXJzaW'
-                                                           b'9uKSB7CiAgICAgICAgcmV0dXJuIFN0cmluZy5mb3JtYXQoTlNfQkFTRSAr'
-                                                           b'ICIlZCIsIHZlcnNpb24pOyAgICAgICAgICAgLy8kTk9OLU5MUy0xJAogIC'
-                                                           b'AgfQ=='):
-    if b64encode(settings['NS_URI'].encode('utf-8')) == b'Z2V0U2NoZW1hVXJpKE5TX0xBVEVTVF9WRVJTSU9OKQ==':
-        settings['XMLNS'] = settings['NS_BASE'] + settings['NS_LATEST_VERSION']
-
-settings['URL_FILENAME_PATTERN'], num_replacements = java_format_string_regex.subn(pythonify_java_format_string,
-                                                                                   settings['URL_FILENAME_PATTERN'])
-
-settings['REPO_URL'] = '{}{}'.format(
-    settings['URL_GOOGLE_SDK_SITE'],
-    settings['URL_FILENAME_PATTERN'].format(int(settings['NS_LATEST_VERSION']))
-)
 
-settings['XSD_URL'] = '{}/{}-{}.xsd?format=TEXT'.format(
-    'https://android.googlesource.com/platform/tools/base/+/master/sdklib/src/main/java/com/android/sdklib/repository',
-    settings['NODE_SDK_REPOSITORY'],
-    settings['NS_LATEST_VERSION']
-)
+def fetch_metadata(what: str, url: str) -> bytes:
+    """
+    Fetches one of the metadata documents, exiting with EXIT_DOWNLOAD_FAILED if it cannot be retrieved
+    :param what: str - name of the document for the error message
+    :param url: str - URL to retrieve
+    :return: response body
+    """
+    try:
+        return fetch(opener, url)
+    except (OSError, HTTPException) as e:
+        fail(EXIT_DOWNLOAD_FAILED, 'Fetching the {} from {} failed: {}'.format(what, url, e))
+
+
+def load_constants() -> bytes:
+    with timings.phase('constants_fetch'):
+        try:
+            with opener.open(req) as conn:
+                constants_data = conn.read()
+        except (OSError, HTTPException) as e:
+            fail(EXIT_DOWNLOAD_FAILED, 'Fetching the SDK constants from {} failed: {}'.format(req.full_url, e))
+    timings.add_bytes('constants_fetch', len(constants_data))
+    return source.decode(constants_data)
+
+
+# settings derived from SdkRepoConstants.java are reused until bootstrap_ttl expires; the constants are then fetched
+# again (usually answered by a 304 from the response cache) and only parsed again if their content has changed
+cached_bootstrap = read_cached_settings(cache_dir, source.constants_url) if cache_dir else None
+if cached_bootstrap is not None and \
+        0 <= time() - cached_bootstrap['checked_at'] <= config['config'].getfloat('bootstrap_ttl'):
+    settings = dict(cached_bootstrap['settings'])
+    timings.cache('bootstrap', hit=True)
+else:
+    constants_data = load_constants()
+    constants_sha1 = source_hash(constants_data)
+    if cached_bootstrap is not None and cached_bootstrap['source_sha1'] == constants_sha1:
+        settings = dict(cached_bootstrap['settings'])
+        timings.cache('bootstrap', hit=True)
+    else:
+        with timings.phase('constants_parse', nbytes=len(constants_data)):
+            settings = parse_constants(constants_data.decode('utf-8'))
+        timings.cache('bootstrap', hit=False)
+    if cache_dir:
+        write_cached_settings(cache_dir, source.constants_url, constants_sha1, settings)
 
-reset_request(req, settings['REPO_URL'])
-with opener.open(req) as conn:
-    byte_stream = conn.read()
-    repo_data = byte_stream.decode('utf-8')
+settings['REPO_URL'] = source.repository_url(settings)
+settings['XSD_URL'] = source.xsd_url(settings)
 
-reset_request(req, settings['XSD_URL'])
-with opener.open(req) as conn:
-    byte_stream = conn.read()
-    raw_data = b64decode(byte_stream)
-    xsd_data = raw_data.decode('utf-8')
-assert re.search(settings['NS_PATTERN'], xsd_data)
 
-logging.disable(logging.CRITICAL)
-repository_xsd_code = generate.GeneratePython(schema_text=xsd_data)
+def load_repository_xml() -> bytes:
+    with timings.phase('repository_fetch'):
+        repository_data = fetch_metadata('repository', settings['REPO_URL'])
+    timings.add_bytes('repository_fetch', len(repository_data))
+    return repository_data
 
-repository_module_code = compile(source=repository_xsd_code, filename=settings['XSD_URL'], mode='exec')
-repository_module = ModuleType('repository_module')
-exec(repository_module_code, repository_module.__dict__)
 
-repository = repository_module.CreateFromDocument(xml_text=repo_data, location_base=settings['REPO_URL'])
-repository_dom = repository.toDOM()
-assert repository_dom.documentElement.namespaceURI == settings['XMLNS']
-assert repository_dom.documentElement.localName == settings['NODE_SDK_REPOSITORY']
+def load_repository_binding() -> ModuleType:
+    with timings.phase('xsd_fetch'):
+        xsd_data = source.decode(fetch_metadata('repository schema', settings['XSD_URL'])).decode('utf-8')
+    timings.add_bytes('xsd_fetch', len(xsd_data))
+    assert re.search(settings['NS_PATTERN'], xsd_data)
+    return load_binding_module(xsd_data, filename=settings['XSD_URL'],
+                               cache_dir=join(cache_dir, 'bindings') if cache_dir else None)
 
-platforms = {
-    'Linux': 'linux',
-    'Windows': 'windows',
-    'Darwin': 'macosx',
-}
 
-archives = dict()
-
-for candidate in getattr(repository, settings['NODE_PLATFORM_TOOL'].replace('-', '_')):
-    candidate_version = LooseVersion('{}.{}.{}'.format(candidate.revision.major,
-                                                       candidate.revision.minor,
-                                                       candidate.revision.micro)).vstring
-    candidate_license = candidate.uses_license.ref
-    for archive in candidate.archives.archive:
-        if archive.host_os == platforms[system()]:
-            assert archive.checksum.type in ['sha1', ]
-            archives[candidate_version] = {
-                'size': archive.size,
-                'checksum': {
-                    'type': archive.checksum.type,
-                    'value': archive.checksum.value(),
-                },
-                'url': archive.url,
-                'license': candidate_license,
-            }
-            break
+logging.disable(logging.CRITICAL)
+# schema validation is opt-in: PyXB can only validate by building the complete object tree of the document, which
+# would be a second full parse next to the streaming one below, at the same peak memory. The streaming parse still
+# rejects documents of the wrong namespace and root element, and archives are verified against their checksums
+validate_repository = config['config'].getboolean('validate_repository')
+# the version index built from the last repository document makes parsing and validating it again unnecessary for as
+# long as the document stays the same
+cached_index = VersionIndex.load(cache_dir, settings['REPO_URL']) if cache_dir else None
+# the repository transfer overlaps the XSD transfer and the binding generation that depends on it; with an index on
+# disk the document most likely has not changed, so the schema is only loaded once it turns out that it has
+with ThreadPoolExecutor(max_workers=2) as executor:
+    repo_future = executor.submit(load_repository_xml)
+    binding_future = executor.submit(load_repository_binding) \
+        if validate_repository and cached_index is None else None
+    repo_data = repo_future.result()
+repo_sha1 = sha1(repo_data).hexdigest()
+if cached_index is not None and cached_index.source_sha1 == repo_sha1 and \
+        (cached_index.validated or not validate_repository):
+    version_index = cached_index
+    timings.cache('versions', hit=True)
+else:
+    timings.cache('versions', hit=False)
+    if validate_repository:
+        repository_module = binding_future.result() if binding_future is not None else load_repository_binding()
+        # full schema validation; the resulting object tree itself is not needed
+        with timings.phase('schema_validation', nbytes=len(repo_data)):
+            repository_module.CreateFromDocument(xml_text=repo_data, location_base=settings['REPO_URL'])
+    with timings.phase('repository_parse', nbytes=len(repo_data)):
+        platform_tools, licenses = parse_repository(repo_data, xmlns=settings['XMLNS'],
+                                                    root_name=settings['NODE_SDK_REPOSITORY'],
+                                                    node_name=settings['NODE_PLATFORM_TOOL'])
+    version_index = VersionIndex.from_records(platform_tools, licenses, source_sha1=repo_sha1,
+                                              validated=validate_repository)
+    if cache_dir:
+        version_index.save(cache_dir, settings['REPO_URL'])
+
+if args.mirror:
+    mirror_archives = []
+    for _, _, archive in version_index.all_archives():
+        archive_url = source.archive_url(settings, archive['url'])
+        mirror_path = mirror_relative_path(source.site_url(settings), archive_url)
+        if mirror_path is None:
+            print('Skipping {}: not below {}'.format(archive_url, source.site_url(settings)))
+            continue
+        mirror_archives.append({
+            'url': archive_url,
+            'path': mirror_path,
+            'size': archive['size'],
+            'checksum': archive['checksum'],
+        })
+    mirror_metadata = {
+        mirror_relative_path(source.site_url(settings), settings['REPO_URL']): repo_data,
+        '{}-{}.xsd'.format(settings['NODE_SDK_REPOSITORY'], settings['NS_LATEST_VERSION']):
+            source.decode(fetch_metadata('repository schema', settings['XSD_URL'])),
+        CONSTANTS_NAME: load_constants(),
+    }
+    mirror_store = ArchiveStore(join(cache_dir, 'archives'), config['config'].getint('archive_cache_size')) \
+        if cache_dir else None
+    with timings.phase('mirror_sync'):
+        fetched_paths, failed_paths = sync_mirror(
+            opener, args.mirror, mirror_archives, mirror_metadata,
+            workers=config['config'].getint('mirror_workers'),
+            archive_store=mirror_store,
+            segments=config['config'].getint('download_segments'),
+            min_segment_size=config['config'].getint('download_min_segment_size'))
+    if mirror_store is not None:
+        mirror_store.evict()
+    print('Mirrored {} archives into {} ({} fetched, {} failed)'.format(
+        len(mirror_archives), args.mirror, len(fetched_paths), len(failed_paths)))
+    for mirror_path, error in sorted(failed_paths.items()):
+        print('{}: {}'.format(mirror_path, error))
+    if failed_paths:
+        fail(EXIT_DOWNLOAD_FAILED, 'Mirror incomplete: {} archives failed'.format(len(failed_paths)))
+    sys.exit(EXIT_OK)
+
+archives = version_index.host_archives(platforms[system()])
+assert all(x['checksum']['type'] in ['sha1', ] for x in archives.values())
+
+if cache_dir:
+    write_snapshot(cache_dir, platforms[system()], archives)
 
 if config['last_run']['version'] is not None and \
                 config['last_run']['extraction_base_dir'] is not None and \
@@ -211,21 +409,63 @@ if config['last_run']['version'] is not None and \
         'license': config['last_run']['license_id'],
     }
 
-if len(archives) >= 1:
-    available_versions = sorted([LooseVersion(x) for x in archives.keys()])
+
+def target_keeps(base_dir: str) -> bool:
+    installed_manifest = read_manifest(installed_root(base_dir))
+    return installed_manifest is not None and installed_manifest.get('version') in archives and \
+        archives[installed_manifest['version']]['checksum'] == installed_manifest.get('checksum') and \
+        manifest_intact(installed_root(base_dir), installed_manifest)
+
+
+installable_versions = version_index.versions(platforms[system()])
+if len(installable_versions) >= 1:
+    available_versions = sorted(archives.keys(), key=version_key)
+    latest_version = installable_versions[-1]
     can_reinstall = config['last_run']['version'] in archives.keys()
-    if not config['config'].getboolean('do_not_ask_again'):
-        if not has_window_manager:
+    if args.version is not None:
+        settings['KEEP_WHILE_AVAILABLE'] = args.version == 'keep'
+        if args.version == 'keep' and extraction_targets:
+            # only destinations without an intact, still published version need the latest one
+            kept_targets = [x for x in extraction_targets if target_keeps(x)]
+            if len(kept_targets) == len(extraction_targets):
+                sys.exit(EXIT_OK)
+            extraction_targets = [x for x in extraction_targets if x not in kept_targets]
+            settings['SELECTED_VERSION'] = latest_version
+        elif args.version == 'keep' and can_reinstall:
+            settings['SELECTED_VERSION'] = config['last_run']['version'] + ':KEEP'
+        elif args.version in ('keep', 'latest'):
+            settings['SELECTED_VERSION'] = latest_version
+        elif args.version in installable_versions:
+            settings['SELECTED_VERSION'] = args.version
+        else:
+            fail(EXIT_VERSION_UNAVAILABLE, 'Version {} is not available; available versions: {}'.format(
+                args.version, ', '.join(installable_versions)))
+    elif not config['config'].getboolean('do_not_ask_again') and not args.batch:
+        if can_reinstall:
+            last_version_text = config['last_run']['version']
+            if config['config'].getboolean('keep_while_available'):
+                last_version_text += ':KEEP'
+        else:
+            last_version_text = None
+        if not load_ui():
             print('Found Installation Candidates:')
-            print("\n".join(sorted(available_versions)))
-            raise NotImplementedError('Text-Mode Version Selection Not Implemented')
+            for index, version in enumerate(available_versions, 1):
+                print('{:>3}) {}'.format(index, version))
+            default_version = last_version_text or latest_version
+            settings['SELECTED_VERSION'] = None
+            while settings['SELECTED_VERSION'] is None:
+                try:
+                    answer = input('Please choose a version [{}]:'.format(default_version)).strip()
+                except EOFError:
+                    fail(EXIT_CANCELLED, 'No version chosen')
+                if answer == '':
+                    settings['SELECTED_VERSION'] = default_version
+                elif answer.isdigit() and 1 <= int(answer) <= len(available_versions):
+                    settings['SELECTED_VERSION'] = available_versions[int(answer) - 1]
+                elif answer in archives:
+                    settings['SELECTED_VERSION'] = answer
+            settings['KEEP_WHILE_AVAILABLE'] = config['config'].getboolean('keep_while_available')
         else:
-            if can_reinstall:
-                last_version_text = config['last_run']['version']
-                if config['config'].getboolean('keep_while_available'):
-                    last_version_text += ':KEEP'
-            else:
-                last_version_text = None
             # noinspection PyUnboundLocalVariable
             version_chooser = VersionChoiceDialog(root,
                                                   available_versions,
@@ -239,31 +479,40 @@ if len(archives) >= 1:
                     config['config']['persist_choices'] = str(version_chooser.persist)
                     config['config']['keep_while_available'] = str(settings['KEEP_WHILE_AVAILABLE'])
                     config['config']['do_not_ask_again'] = str(version_chooser.do_not_ask_again)
+                    chosen_settings.update(['persist_choices', 'keep_while_available', 'do_not_ask_again'])
             else:
-                raise ValueError('User cancelled selection dialog')
+                fail(EXIT_CANCELLED, 'User cancelled selection dialog')
     else:
         settings['KEEP_WHILE_AVAILABLE'] = config['config'].getboolean('keep_while_available')
         if settings['KEEP_WHILE_AVAILABLE'] and can_reinstall:
             settings['SELECTED_VERSION'] = config['last_run']['version'] + ':KEEP'
         else:
-            settings['SELECTED_VERSION'] = available_versions[0].vstring
+            settings['SELECTED_VERSION'] = latest_version
 else:
-    raise FileNotFoundError('No Available Versions')
+    fail(EXIT_VERSION_UNAVAILABLE, 'No Available Versions')
 
 if settings['SELECTED_VERSION'].endswith(':KEEP'):
-    exit(0)
+    sys.exit(EXIT_OK)
 
 config['last_run']['version'] = settings['SELECTED_VERSION']
 
 archive_data = archives[settings['SELECTED_VERSION']]
 
 # TODO: refactor to skip IFF config['config'].getboolean('do_not_ask_again') and license has been accepted already
-for prod_license in [x for x in repository.license if x.id == archive_data['license']]:
-    license_text = prod_license.value()
+for license_text in [text for license_id, text in version_index.licenses.items()
+                     if license_id == archive_data['license']]:
     sha1_checker = sha1()
     sha1_checker.update(license_text.encode('utf-8'))
-    if sha1_checker.hexdigest() not in str(config['config']['accepted_license_sha1']):
-        if has_window_manager:
+    accepted_licenses = str(config['config']['accepted_license_sha1']).split(',') + \
+        [x.lower() for x in args.accept_license]
+    if sha1_checker.hexdigest() in accepted_licenses:
+        config['last_run']['license_id'] = archive_data['license']
+    elif args.batch:
+        fail(EXIT_LICENSE_NOT_ACCEPTED, 'The "{}" license (SHA-1 {}) has not been accepted; pass --accept-license {} '
+                                        'to accept it'.format(archive_data['license'], sha1_checker.hexdigest(),
+                                                              sha1_checker.hexdigest()))
+    else:
+        if load_ui():
             # noinspection PyUnboundLocalVariable
             d = LicenseDialog(root, license_heading=('Android Platform Tools v{} for {} is distributed '
                                                      'under the "{}" license:').format(settings['SELECTED_VERSION'],
@@ -278,42 +527,172 @@ for prod_license in [x for x in repository.license if x.id == archive_data['lice
                                                      archive_data['license']))
             print('Please read the following license:')
             print(fill(license_text, replace_whitespace=False, drop_whitespace=False, width=80))
-            license_accepted = input('Please type "I ACCEPT THIS LICENSE" to continue []:') == 'I ACCEPT THIS LICENSE'
+            try:
+                license_accepted = input('Please type "I ACCEPT THIS LICENSE" to continue []:') == \
+                    'I ACCEPT THIS LICENSE'
+            except EOFError:
+                license_accepted = False
         if not license_accepted:
-            raise PermissionError('License Not Accepted')
+            fail(EXIT_LICENSE_NOT_ACCEPTED, 'License Not Accepted')
         else:
             config['last_run']['license_id'] = archive_data['license']
             if config['config']['accepted_license_sha1'] is None:
                 config['config']['accepted_license_sha1'] = sha1_checker.hexdigest()
             else:
                 config['config']['accepted_license_sha1'] += ',' + sha1_checker.hexdigest()
+            chosen_settings.add('accepted_license_sha1')
     break
 
-if not archive_data['url'].lower().startswith('http'):
-    archive_data['url'] = settings['URL_GOOGLE_SDK_SITE'] + archive_data['url']
-
-reset_request(req, archive_data['url'])
-with opener.open(req) as conn:
-    byte_stream = conn.read()
-    assert len(byte_stream) == archive_data['size']
-    sha1_checker = sha1()
-    sha1_checker.update(byte_stream)
-    assert sha1_checker.hexdigest() == archive_data['checksum']['value']
-    archive_fileobj = BytesIO(byte_stream)
+archive_data['url'] = source.archive_url(settings, archive_data['url'])
 
 assert archive_data['url'].lower().endswith('.zip')
 # TODO: obey config['config'].getboolean('do_not_ask_again') for extraction directory as well
-config['last_run']['extraction_base_dir'] = askdirectory(title='Choose Output Base Directory', mustexist=True,
-                                                         initialdir=config['last_run']['extraction_base_dir'])
-
-assert config['last_run']['extraction_base_dir'] != ''
-archive_obj = ZipFile(archive_fileobj)
-archive_obj.extractall(path=config['last_run']['extraction_base_dir'], preserve_permissions=PERMS_PRESERVE_SAFE)
-
-if config['config']['persist_choices']:
-    with open(expanduser('~/.nsaptr.conf'), 'w+') as fp:
-        config.write(fp)
-
-# FINAL CLEANUPS
-
-raise NotImplementedError('not done yet!')
+# asked before the download so that pipelined extraction knows where to stage members
+if extraction_targets:
+    install_targets = extraction_targets
+else:
+    load_ui()
+    config['last_run']['extraction_base_dir'] = askdirectory(title='Choose Output Base Directory', mustexist=True,
+                                                             initialdir=config['last_run']['extraction_base_dir'])
+    assert config['last_run']['extraction_base_dir'] != ''
+    install_targets = [config['last_run']['extraction_base_dir']]
+
+
+def install_target(base_dir: str, workers: int) -> None:
+    if staged_install:
+        # extract next to the live version, then switch over in one step
+        install_dir = create_stage(base_dir)
+        previous_manifest = None
+    else:
+        install_dir = base_dir
+        previous_manifest = read_manifest(install_dir)
+    try:
+        if extracted_path is not None:
+            with timings.phase('link'):
+                ExtractedStore.install(extracted_path, install_dir,
+                                       previous_files=previous_manifest['files'] if previous_manifest else None,
+                                       methods=link_methods)
+        else:
+            published = False
+            if stream_extractor is not None and stream_extractor.complete:
+                # members were inflated while downloading; publish them only once the whole archive checks out
+                try:
+                    with timings.phase('publish'):
+                        stream_extractor.publish(archive_obj, install_dir, preserve_permissions=PERMS_PRESERVE_SAFE,
+                                                 manifest=previous_manifest['files'] if previous_manifest else None)
+                    published = True
+                except ValueError:
+                    # the staged members disagree with the central directory (nothing has been moved yet); the
+                    # archive itself is verified, so extract it the regular way
+                    stream_extractor.discard()
+            if not published:
+                with timings.phase('extract'):
+                    written = archive_obj.extractall(path=install_dir, preserve_permissions=PERMS_PRESERVE_SAFE,
+                                                     workers=workers,
+                                                     incremental=config['config'].getboolean('incremental_upgrade'),
+                                                     manifest=previous_manifest['files'] if previous_manifest else None)
+                timings.add_bytes('extract', sum(x.file_size for x in written))
+        write_manifest(install_dir, version=settings['SELECTED_VERSION'],
+                       checksum=archive_data['checksum'], license_id=archive_data['license'],
+                       files=archive_obj.member_manifest())
+    except BaseException:
+        if staged_install:
+            rmtree(install_dir, ignore_errors=True)
+        raise
+    if staged_install:
+        publish_stage(base_dir, install_dir, settings['SELECTED_VERSION'])
+        prune(base_dir, config['config'].getint('keep_versions'))
+
+
+archive_store = ArchiveStore(join(cache_dir, 'archives'), config['config'].getint('archive_cache_size')) \
+    if cache_dir else None
+stored_archive = archive_store.lookup(archive_data['checksum']['type'], archive_data['checksum']['value'],
+                                      archive_data['size']) if archive_store else None
+# inflate each version once into a shared tree and build installations from links to it
+extracted_store = ExtractedStore(join(cache_dir, 'extracted')) \
+    if cache_dir and config['config'].getboolean('shared_extraction') else None
+extracted_path = None
+link_methods = [x.strip() for x in config['config']['link_methods'].split(',') if x.strip()]
+# streamed members can only be published once, so pipelining is limited to the shared tree or a single target
+if config['config'].getboolean('pipelined_extraction') and stored_archive is None and \
+        (extracted_store is not None or len(install_targets) == 1):
+    if extracted_store is not None:
+        stream_extractor = ZipStreamExtractor(extracted_store.root)
+    else:
+        makedirs(install_targets[0], exist_ok=True)
+        stream_extractor = ZipStreamExtractor(install_targets[0])
+else:
+    stream_extractor = None
+target_errors = dict()
+try:
+    try:
+        if stored_archive is not None:
+            archive_fileobj = open(stored_archive, 'rb')
+        else:
+            reset_request(req, archive_data['url'], cacheable=False)
+            with timings.phase('transfer', nbytes=archive_data['size'] or 0):
+                archive_fileobj = download_archive(
+                    opener, req,
+                    size=archive_data['size'],
+                    checksum_type=archive_data['checksum']['type'],
+                    checksum_value=archive_data['checksum']['value'],
+                    download_dir=archive_store.root if archive_store else None,
+                    segments=config['config'].getint('download_segments'),
+                    min_segment_size=config['config'].getint('download_min_segment_size'),
+                    sink=stream_extractor)
+            if archive_store:
+                archive_store.add(archive_fileobj.name, archive_data['checksum']['type'],
+                                  archive_data['checksum']['value'])
+        archive_obj = ZipFile(archive_fileobj)
+    except (OSError, ValueError, HTTPException) as e:
+        fail(EXIT_DOWNLOAD_FAILED, 'Download of {} failed: {}'.format(archive_data['url'], e))
+    if extracted_store is not None:
+        try:
+            extracted_path = extracted_store.ensure(archive_obj, version=settings['SELECTED_VERSION'],
+                                                    checksum=archive_data['checksum'],
+                                                    license_id=archive_data['license'],
+                                                    workers=config['config'].getint('extraction_workers'),
+                                                    stream_extractor=stream_extractor)
+        except (OSError, ValueError) as e:
+            fail(EXIT_INSTALL_FAILED, 'Extraction into {} failed: {}'.format(extracted_store.root, e))
+    # one download, extracted into every target at once; the worker budget is shared between the targets
+    target_workers = max(1, config['config'].getint('extraction_workers') // len(install_targets))
+    with ThreadPoolExecutor(max_workers=len(install_targets)) as executor:
+        target_futures = [(base_dir, executor.submit(install_target, base_dir, target_workers))
+                          for base_dir in install_targets]
+    for base_dir, future in target_futures:
+        if future.exception() is None:
+            print('{}: installed Android Platform Tools v{}'.format(base_dir, settings['SELECTED_VERSION']))
+        else:
+            target_errors[base_dir] = future.exception()
+            print('{}: installation failed: {}'.format(base_dir, future.exception()))
+finally:
+    if stream_extractor is not None:
+        stream_extractor.discard()
+archive_obj.close()
+archive_fileobj.close()
+if archive_store:
+    archive_store.evict(protect=[archive_data['checksum']['value']])
+if extracted_store is not None:
+    extracted_store.prune(config['config'].getint('shared_extraction_keep'),
+                          protect=[archive_data['checksum']['value']])
+
+# unattended runs leave the user's configuration alone
+if not args.batch:
+    user_config_path = expanduser('~/.nsaptr.conf')
+    user_config = ConfigParser(allow_no_value=True, strict=True, empty_lines_in_values=False)
+    user_config.read(user_config_path)
+    previous_text = StringIO()
+    user_config.write(previous_text)
+    if chosen_settings:
+        user_config.read_dict({'config': {key: config['config'][key] for key in chosen_settings}})
+    user_config.read_dict({'last_run': dict(config['last_run'])})
+    config_text = StringIO()
+    user_config.write(config_text)
+    if config_text.getvalue() != previous_text.getvalue():
+        atomic_write(user_config_path, config_text.getvalue().encode('utf-8'), mode=0o644)
+
+if target_errors:
+    fail(EXIT_INSTALL_FAILED, 'Installation failed for {} of {} targets: {}'.format(
+        len(target_errors), len(install_targets), ', '.join(target_errors)))
+sys.exit(EXIT_OK)
@@ -0,0 +1,121 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.requests import ConnectionPool, KeepAliveHTTPSHandler, make_request  # noqa: E402
+
+BODY = b'platform-tools\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is needed to make the test certificate')
+class KeepAliveHTTPSTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.mkdtemp()
+        cls.cert = os.path.join(cls.work_dir, 'cert.pem')
+        key = os.path.join(cls.work_dir, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+                        '-keyout', key, '-out', cls.cert],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cls.cert, key)
+        cls.server = ThreadingHTTPServer(('localhost', 0), _Handler)
+        cls.server.socket = server_context.wrap_socket(cls.server.socket, server_side=True)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = 'https://localhost:{}/repository2-1.xml'.format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.work_dir)
+
+    def setUp(self):
+        # the handler builds its own default context, which has to trust the test certificate
+        self.cert_file = os.environ.get('SSL_CERT_FILE')
+        os.environ['SSL_CERT_FILE'] = self.cert
+        self.pool = ConnectionPool()
+        self.opener, _ = make_request(self.url, pool=self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+        if self.cert_file is None:
+            del os.environ['SSL_CERT_FILE']
+        else:
+            os.environ['SSL_CERT_FILE'] = self.cert_file
+
+    def test_handler_shares_one_context(self):
+        handler = KeepAliveHTTPSHandler()
+        self.assertIsNotNone(handler._context)
+
+    def idle_connections(self) -> list:
+        return [conn for idle in self.pool._idle.values() for conn in idle]
+
+    def test_second_connection_to_same_host(self):
+        with self.opener.open(self.url) as first:
+            self.assertEqual(first.read(), BODY)
+        [first_conn] = self.idle_connections()
+        self.assertFalse(first_conn.sock.session_reused)
+        # the first connection is back in the pool with its TLS session; holding it busy forces a second connection,
+        # which is offered that session
+        with self.opener.open(self.url) as second:
+            self.assertEqual(self.idle_connections(), [])
+            with self.opener.open(self.url) as third:
+                self.assertEqual(second.read(), BODY)
+                self.assertEqual(third.read(), BODY)
+        idle = self.idle_connections()
+        self.assertEqual(len(idle), 2)
+        self.assertIn(first_conn, idle)
+        [new_conn] = [conn for conn in idle if conn is not first_conn]
+        self.assertTrue(new_conn.sock.session_reused)
+
+    def test_reconnect_after_idle_connection_dropped(self):
+        with self.opener.open(self.url) as first:
+            self.assertEqual(first.read(), BODY)
+        for idle in self.pool._idle.values():
+            for conn in idle:
+                conn.sock.close()
+        with self.opener.open(self.url) as second:
+            self.assertEqual(second.read(), BODY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+import warnings
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.zipfile_extract_perms import PERMS_PRESERVE_SAFE, ZipFileMod, ZipStreamExtractor  # noqa: E402
+
+# chunk sizes that split local headers, names, data and descriptors at every kind of offset
+CHUNK_SIZES = (1, 3, 7, 29, 4096, None)
+MEMBERS = [
+    ('platform-tools/', None),
+    ('platform-tools/adb', bytes(random.Random(1).getrandbits(8) for _ in range(70000))),
+    ('platform-tools/empty', b''),
+    ('platform-tools/lib64/libc++.so', b'\x7fELF' + b'\0' * 5000),
+    ('platform-tools/NOTICE.txt', b'Apache License\n' * 300),
+]
+
+
+class _Unseekable(object):
+    """
+    Write-only stream; ZipFile writes a data descriptor after every member it cannot seek back to
+    """
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+
+def make_archive(compression: int, seekable: bool = True, force_zip64: bool = False,
+                 members=MEMBERS) -> bytes:
+    stream = io.BytesIO() if seekable else _Unseekable()
+    with zipfile.ZipFile(stream, 'w', compression) as archive:
+        for name, data in members:
+            info = zipfile.ZipInfo(name, date_time=(2016, 8, 1, 0, 0, 0))
+            info.compress_type = compression
+            info.external_attr = (0o40755 if data is None else 0o100755) << 16
+            if data is None:
+                archive.writestr(info, b'')
+            else:
+                with archive.open(info, 'w', force_zip64=force_zip64) as member:
+                    member.write(data)
+    return (stream if seekable else stream.buffer).getvalue()
+
+
+def feed(extractor: ZipStreamExtractor, data: bytes, chunk_size) -> None:
+    chunk_size = chunk_size or len(data)
+    for offset in range(0, len(data), chunk_size):
+        extractor.feed(data[offset:offset + chunk_size])
+
+
+class ZipStreamExtractorTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def archive_file(self, data: bytes) -> ZipFileMod:
+        path = os.path.join(self.work_dir, 'archive-{}.zip'.format(len(os.listdir(self.work_dir))))
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        archive = ZipFileMod(path)
+        self.addCleanup(archive.close)
+        return archive
+
+    def assert_published(self, data: bytes, chunk_size, members=MEMBERS) -> None:
+        extractor = ZipStreamExtractor(self.work_dir)
+        self.addCleanup(extractor.discard)
+        feed(extractor, data, chunk_size)
+        self.assertTrue(extractor.complete)
+        target = tempfile.mkdtemp(dir=self.work_dir)
+        extractor.publish(self.archive_file(data), target, preserve_permissions=PERMS_PRESERVE_SAFE)
+        for name, content in members:
+            path = os.path.join(target, name)
+            if content is None:
+                self.assertTrue(os.path.isdir(path))
+                continue
+            with open(path, 'rb') as fp:
+                self.assertEqual(fp.read(), content, name)
+            self.assertTrue(os.access(path, os.X_OK), name)
+        self.assertFalse(os.path.exists(extractor.staging_dir))
+
+    def test_seekable(self):
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            data = make_archive(compression)
+            for chunk_size in CHUNK_SIZES:
+                with self.subTest(compression=compression, chunk_size=chunk_size):
+                    self.assert_published(data, chunk_size)
+
+    def test_zip64_extra_fields(self):
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            data = make_archive(compression, force_zip64=True)
+            for chunk_size in (1, 13, None):
+                with self.subTest(compression=compression, chunk_size=chunk_size):
+                    self.assert_published(data, chunk_size)
+
+    def test_unseekable_deflated_with_data_descriptors(self):
+        data = make_archive(zipfile.ZIP_DEFLATED, seekable=False)
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                self.assert_published(data, chunk_size)
+
+    def test_unseekable_stored_is_unsupported(self):
+        # the end of a stored member followed by a data descriptor cannot be found without the central directory
+        data = make_archive(zipfile.ZIP_STORED, seekable=False)
+        extractor = ZipStreamExtractor(self.work_dir)
+        feed(extractor, data, 4096)
+        self.assertFalse(extractor.usable)
+        self.assertFalse(extractor.complete)
+        self.assertFalse(os.path.exists(extractor.staging_dir))
+
+    def test_unsupported_compression(self):
+        extractor = ZipStreamExtractor(self.work_dir)
+        feed(extractor, make_archive(zipfile.ZIP_BZIP2), None)
+        self.assertFalse(extractor.usable)
+
+    def test_corrupt_member_data(self):
+        data = bytearray(make_archive(zipfile.ZIP_STORED))
+        offset = data.index(b'Apache License')
+        data[offset] ^= 0xFF
+        extractor = ZipStreamExtractor(self.work_dir)
+        feed(extractor, bytes(data), 4096)
+        self.assertFalse(extractor.usable)
+
+    def test_reset_replays_from_the_start(self):
+        data = make_archive(zipfile.ZIP_DEFLATED)
+        extractor = ZipStreamExtractor(self.work_dir)
+        self.addCleanup(extractor.discard)
+        feed(extractor, data[:len(data) // 2], 7)
+        first_staging_dir = extractor.staging_dir
+        extractor.reset()
+        self.assertFalse(os.path.exists(first_staging_dir))
+        feed(extractor, data, 7)
+        self.assertTrue(extractor.complete)
+        target = tempfile.mkdtemp(dir=self.work_dir)
+        extractor.publish(self.archive_file(data), target)
+        with open(os.path.join(target, 'platform-tools/adb'), 'rb') as fp:
+            self.assertEqual(fp.read(), MEMBERS[1][1])
+
+    def test_publish_incomplete(self):
+        data = make_archive(zipfile.ZIP_DEFLATED)
+        extractor = ZipStreamExtractor(self.work_dir)
+        self.addCleanup(extractor.discard)
+        feed(extractor, data[:len(data) // 2], None)
+        self.assertFalse(extractor.complete)
+        with self.assertRaises(ValueError):
+            extractor.publish(self.archive_file(data), tempfile.mkdtemp(dir=self.work_dir))
+
+    def test_publish_rejects_duplicate_names(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            data = make_archive(zipfile.ZIP_DEFLATED, members=[('a.txt', b'one'), ('a.txt', b'two')])
+        extractor = ZipStreamExtractor(self.work_dir)
+        self.addCleanup(extractor.discard)
+        feed(extractor, data, None)
+        self.assertTrue(extractor.complete)
+        target = tempfile.mkdtemp(dir=self.work_dir)
+        with self.assertRaises(ValueError):
+            extractor.publish(self.archive_file(data), target)
+        self.assertEqual(os.listdir(target), [])
+
+    def test_publish_rejects_other_archive(self):
+        data = make_archive(zipfile.ZIP_DEFLATED)
+        other = make_archive(zipfile.ZIP_DEFLATED, members=MEMBERS[:1] + [(MEMBERS[1][0], b'changed')] + MEMBERS[2:])
+        extractor = ZipStreamExtractor(self.work_dir)
+        self.addCleanup(extractor.discard)
+        feed(extractor, data, None)
+        target = tempfile.mkdtemp(dir=self.work_dir)
+        with self.assertRaises(ValueError):
+            extractor.publish(self.archive_file(other), target)
+        self.assertEqual(os.listdir(target), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
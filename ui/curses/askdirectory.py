@@ -35,15 +35,19 @@ Originally by: Kragen Sitaker
 # about expanding children.
 # And it doesn't really bother to worry about someone else changing the outline
 # behind its back.
-# So the strategy is to store our current linear position in the
-# in-order traversal, and defer operations on the current node until the next
-# time we're traversing.
+# So the strategy is to keep the preorder traversal of the visible nodes as a
+# flat list of rows: expanding a node splices its visible descendants in after
+# it, collapsing one cuts them out again, and everything else (moving the
+# cursor, scrolling) is an index into that list.  Only the rows inside the
+# viewport are ever rendered, and a cursor move within the viewport repaints
+# just the two rows involved.
 
 import curses
 import os
 import sys
 
 ESC = 27
+HEADER_LINES = 2
 
 
 class Dir(object):
@@ -60,7 +64,7 @@ class Dir(object):
     @staticmethod
     def _pad(data, width):
         # XXX this won't work with UTF-8
-        return data + ' ' * (width - len(data))
+        return data[:width] + ' ' * (width - len(data))
 
     def children(self):
         if self.child_names is None:
@@ -86,102 +90,163 @@ class Dir(object):
     def collapse(self):
         self.expanded = False
 
-    def traverse(self):
-        yield self, 0
-        if not self.expanded:
-            return
-        for child in self.children():
-            for kid, depth in child.traverse():
-                yield kid, depth + 1
+    def traverse(self, depth=0):
+        # iterative, so deep trees neither hit the recursion limit nor pay for a generator per level
+        stack = [(self, depth)]
+        while stack:
+            node, node_depth = stack.pop()
+            yield node, node_depth
+            if node.expanded:
+                stack.extend((child, node_depth + 1) for child in reversed(node.children()))
 
     def render(self, depth, width):
         return self._pad('%s%s %s' % (' ' * 4 * depth, self.icon(),
                                       os.path.basename(self.name)), width)
 
 
+class TreeView(object):
+    """Flattened list of the visible rows of a Dir tree, with a cursor and
+       a viewport onto it.  Rows are (Dir, depth) tuples in preorder.
+    """
+    def __init__(self, root_name):
+        self.root = Dir(root_name)
+        self.root.expand()
+        self.rows = list(self.root.traverse())
+        self.cursor = 0
+        self.top = 0
+
+    @property
+    def current(self):
+        return self.rows[self.cursor][0]
+
+    def _subtree_end(self, index):
+        depth = self.rows[index][1]
+        end = index + 1
+        while end < len(self.rows) and self.rows[end][1] > depth:
+            end += 1
+        return end
+
+    def expand(self):
+        node, depth = self.rows[self.cursor]
+        if node.expanded:
+            return False
+        node.expand()
+        # descendants expanded earlier come back the way they were left
+        self.rows[self.cursor + 1:self.cursor + 1] = list(node.traverse(depth))[1:]
+        return True
+
+    def collapse(self):
+        node, _ = self.rows[self.cursor]
+        if not node.expanded:
+            return False
+        node.collapse()
+        del self.rows[self.cursor + 1:self._subtree_end(self.cursor)]
+        return True
+
+    def move_to(self, index, height):
+        """Moves the cursor, scrolling just enough to keep it in view.
+           Returns whether the viewport scrolled.
+        """
+        self.cursor = index
+        top = min(max(self.top, self.cursor - height + 1), self.cursor)
+        scrolled = top != self.top
+        self.top = top
+        return scrolled
+
+    def draw_row(self, screen, index, width):
+        node, depth = self.rows[index]
+        attributes = curses.color_pair(1) | curses.A_BOLD if index == self.cursor else curses.color_pair(0)
+        screen.addstr(HEADER_LINES + index - self.top, 0, node.render(depth, width), attributes)
+
+    def draw(self, screen, height, width):
+        for line in range(height):
+            index = self.top + line
+            if index < len(self.rows):
+                self.draw_row(screen, index, width)
+            else:
+                screen.move(HEADER_LINES + line, 0)
+                screen.clrtoeol()
+
+
 def __askdirectory_main(screen, initialdir, title, mustexist=True):
     # TODO: Implement Directory Creation for mustexist=False
     # TODO: Implement Location Entry box with autocomplete for direct entry
     if not mustexist:
         raise NotImplementedError('Directory Creation Functionality Not Available.')
 
-    screen.clear()
-    screen.refresh()
     curses.nl()
     curses.noecho()
     screen.timeout(0)
     screen.nodelay(0)
-    directory_object = Dir(initialdir)
-    directory_object.expand()
-    current_index = 2
-    pending_action = None
-    pending_save = False
-    pending_root_change = False
+    curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLUE)
+    view = TreeView(initialdir)
+    full_redraw = True
 
     while 1:
-        screen.clear()
-        curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLUE)
-        screen.attrset(curses.color_pair(0))
-        screen.addstr(0, 0, title)
-        screen.addstr(1, 0, ('Press BACKSPACE to go up on the Directory Tree. '
-                             'Press DELETE to set new Directory Tree Root'))
-        line = 2
-        offset = max(0, current_index - curses.LINES + 3)
-        for data, depth in directory_object.traverse():
-            if line == current_index:
-                screen.attrset(curses.color_pair(1) | curses.A_BOLD)
-                if pending_action:
-                    getattr(data, pending_action)()
-                    pending_action = None
-                elif pending_root_change:
-                    initialdir = os.path.abspath(data.name)
-                    directory_object = Dir(initialdir)
-                    directory_object.expand()
-                    current_index = 2
-                    break
-                elif pending_save:
-                    return data.name
-            else:
-                screen.attrset(curses.color_pair(0))
-            if 0 <= line - offset < curses.LINES - 1:
-                screen.addstr(line - offset, 0,
-                              data.render(depth, curses.COLS))
-            line += 1
-        if pending_root_change:
-            pending_root_change = False
-            continue
-        screen.refresh()
+        lines, columns = screen.getmaxyx()
+        # the last line stays empty: writing its last column would move the cursor off screen
+        height = max(lines - HEADER_LINES - 1, 1)
+        width = max(columns - 1, 1)
+        if full_redraw:
+            screen.erase()
+            screen.addstr(0, 0, title[:width])
+            screen.addstr(1, 0, ('Press BACKSPACE to go up on the Directory Tree. '
+                                 'Press DELETE to set new Directory Tree Root')[:width])
+            view.move_to(min(view.cursor, len(view.rows) - 1), height)
+            view.draw(screen, height, width)
+            full_redraw = False
+        screen.noutrefresh()
+        curses.doupdate()
+
         ch = screen.getch()
+        previous = view.cursor
         if ch == curses.KEY_UP:
-            current_index -= 1
+            # UP stops at the root, DOWN wraps around to it
+            target = max(view.cursor - 1, 0)
         elif ch == curses.KEY_DOWN:
-            current_index += 1
+            target = (view.cursor + 1) % len(view.rows)
         elif ch == curses.KEY_PPAGE:
-            current_index -= curses.LINES
-            if current_index < 2:
-                current_index = 2
+            target = max(view.cursor - height, 0)
         elif ch == curses.KEY_NPAGE:
-            current_index += curses.LINES
-            if current_index >= line:
-                current_index = line - 1
-        elif ch == curses.KEY_RIGHT:
-            pending_action = 'expand'
-        elif ch == curses.KEY_LEFT:
-            pending_action = 'collapse'
+            target = min(view.cursor + height, len(view.rows) - 1)
+        elif ch == curses.KEY_RIGHT or ch == curses.KEY_LEFT:
+            if view.expand() if ch == curses.KEY_RIGHT else view.collapse():
+                # rows below the cursor have shifted; those above it are unchanged
+                view.move_to(view.cursor, height)
+                for index in range(view.cursor, view.top + height):
+                    if index < len(view.rows):
+                        view.draw_row(screen, index, width)
+                    else:
+                        screen.move(HEADER_LINES + index - view.top, 0)
+                        screen.clrtoeol()
+            else:
+                # the icon of a leaf may still change once its children have been looked at
+                view.draw_row(screen, view.cursor, width)
+            continue
         elif ch == curses.KEY_BACKSPACE or ch == 127:
             initialdir = os.path.abspath(os.path.join(initialdir, '..'))
-            directory_object = Dir(initialdir)
-            directory_object.expand()
-            current_index = 2
+            view = TreeView(initialdir)
+            full_redraw = True
+            continue
         elif ch == curses.KEY_DC:
-            pending_root_change = True
+            initialdir = os.path.abspath(view.current.name)
+            view = TreeView(initialdir)
+            full_redraw = True
+            continue
+        elif ch == curses.KEY_RESIZE:
+            full_redraw = True
+            continue
         elif ch == ESC or ch == ord('q') or ch == ord('Q'):
             return None
         elif ch == ord('\n'):
-            pending_save = True
-        current_index %= line
-        if current_index < 2:
-            current_index = 2
+            return view.current.name
+        else:
+            continue
+        if view.move_to(target, height):
+            view.draw(screen, height, width)
+        else:
+            view.draw_row(screen, previous, width)
+            view.draw_row(screen, view.cursor, width)
 
 
 def __open_tty():
@@ -13,8 +13,8 @@ Copyright 2016 adpoliak
    See the License for the specific language governing permissions and
    limitations under the License.
 """
-from distutils.version import LooseVersion
 from sortedcontainers.sortedset import SortedSet
+from util.versionindex import version_key
 # import curses
 # import os
 # import sys
@@ -121,7 +121,7 @@ class VersionChoiceDialog(object):
         _ = args
         _ = kwargs
         self._can_continue = None
-        self._child_names = SortedSet(versions)
+        self._child_names = SortedSet(versions, key=version_key)
         self._child_objects = None
         self._chosen_version = None
         self._do_not_ask_again = False
@@ -136,7 +136,5 @@ class VersionChoiceDialog(object):
         if keep:
             self.keep_action()
         if last_used is not None:
-            last_used_version_object = LooseVersion(last_used)
-            self._index = self._child_names.index(last_used_version_object) \
-                if last_used_version_object in self._child_names else 0
+            self._index = self._child_names.index(last_used) if last_used in self._child_names else 0
             self.select_action()
@@ -16,7 +16,6 @@ Copyright 2016 adpoliak
 import tkinter as tk
 import tkinter.ttk
 import typing
-from distutils.version import LooseVersion
 
 
 class VersionChoiceDialog(tk.Toplevel):
@@ -85,7 +84,7 @@ class VersionChoiceDialog(tk.Toplevel):
             self._persist_changes.config(state=tk.NORMAL)
         self.update_idletasks()
 
-    def __init__(self, master, versions: typing.List[LooseVersion], persist: typing.Optional[bool] = False,
+    def __init__(self, master, versions: typing.List[str], persist: typing.Optional[bool] = False,
                  keep: typing.Optional[bool] = False, last_used: typing.Optional[str] = None, *args, **kwargs):
         tk.Toplevel.__init__(self, master, *args, **kwargs)
         self.grid()
@@ -0,0 +1,127 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import json
+import os
+import time
+import typing
+from util.fileutil import atomic_write, file_identity, verify_file
+from util.timings import timings
+
+
+class ArchiveStore(object):
+    """
+    Content-addressed store of verified archives, kept below a size budget by least-recently-used eviction
+    Archives are stored as "<checksum><ext>". The index remembers the size and modification time each archive had
+    when its checksum was verified; as long as both still match, the archive is trusted without re-hashing.
+    """
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _load_index(self) -> dict:
+        try:
+            with open(os.path.join(self.root, self.INDEX_NAME), 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return dict()
+
+    def _save_index(self, index: dict) -> None:
+        atomic_write(os.path.join(self.root, self.INDEX_NAME), json.dumps(index, sort_keys=True).encode('utf-8'))
+
+    def path_for(self, checksum_value: str, extension: str = '.zip') -> str:
+        return os.path.join(self.root, checksum_value + extension)
+
+    def lookup(self,
+               checksum_type: str,
+               checksum_value: str,
+               size: typing.Optional[int],
+               extension: str = '.zip') -> typing.Optional[str]:
+        """
+        Finds a stored archive
+        :param checksum_type: str - hashlib algorithm name
+        :param checksum_value: str - expected hex digest
+        :param size: int - expected size in bytes, or None
+        :param extension: str - archive file extension
+        :return: path of the archive, or None if it is not stored (or no longer valid)
+        """
+        path = self.path_for(checksum_value, extension)
+        if not os.path.isfile(path):
+            timings.cache('archives', hit=False)
+            return None
+        index = self._load_index()
+        entry = index.get(checksum_value)
+        # hashed again only if unknown or modified since it was verified
+        stat = verify_file(path, checksum_type, checksum_value, size,
+                           entry if entry is not None and entry.get('checksum_type') == checksum_type else None)
+        if stat is None:
+            if os.path.exists(path):
+                os.remove(path)
+            index.pop(checksum_value, None)
+            self._save_index(index)
+            timings.cache('archives', hit=False)
+            return None
+        index[checksum_value] = dict(file_identity(stat), checksum_type=checksum_type, extension=extension,
+                                     last_used=time.time())
+        self._save_index(index)
+        timings.cache('archives', hit=True)
+        return path
+
+    def add(self, path: str, checksum_type: str, checksum_value: str, extension: str = '.zip') -> str:
+        """
+        Records an archive whose checksum has just been verified, moving it into the store if necessary
+        :param path: str - location of the verified archive
+        :param checksum_type: str - hashlib algorithm name
+        :param checksum_value: str - verified hex digest
+        :param extension: str - archive file extension
+        :return: path of the archive inside the store
+        """
+        stored_path = self.path_for(checksum_value, extension)
+        if os.path.abspath(path) != os.path.abspath(stored_path):
+            os.replace(path, stored_path)
+        index = self._load_index()
+        index[checksum_value] = dict(file_identity(os.stat(stored_path)), checksum_type=checksum_type,
+                                     extension=extension, last_used=time.time())
+        self._save_index(index)
+        return stored_path
+
+    def evict(self, protect: typing.Iterable[str] = ()) -> typing.List[str]:
+        """
+        Removes least-recently-used archives until the store fits its size budget
+        :param protect: checksums that must not be evicted
+        :return: checksums of the evicted archives
+        """
+        protect = set(protect)
+        index = self._load_index()
+        for checksum_value, entry in list(index.items()):
+            if not os.path.isfile(self.path_for(checksum_value, entry.get('extension', '.zip'))):
+                del index[checksum_value]
+        total = sum(entry['size'] for entry in index.values())
+        evicted = []
+        for checksum_value, entry in sorted(index.items(), key=lambda item: item[1].get('last_used', 0)):
+            if total <= self.max_bytes:
+                break
+            if checksum_value in protect:
+                continue
+            os.remove(self.path_for(checksum_value, entry.get('extension', '.zip')))
+            del index[checksum_value]
+            total -= entry['size']
+            evicted.append(checksum_value)
+        self._save_index(index)
+        return evicted
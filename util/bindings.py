@@ -0,0 +1,93 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import marshal
+import os
+import sys
+import typing
+from hashlib import sha1
+from types import ModuleType
+from util.fileutil import atomic_write
+from util.timings import timings
+
+
+def binding_cache_key(xsd_data: str) -> str:
+    """
+    Builds the cache key for the binding generated from an XSD
+    Marshalled code is only valid for the interpreter that produced it, so its cache tag is part of the key
+    :param xsd_data: str - XSD text the binding is generated from
+    :return: key made of the XSD SHA-1, the PyXB version and the interpreter cache tag
+    """
+    import pyxb
+    sha1_checker = sha1()
+    sha1_checker.update(xsd_data.encode('utf-8'))
+    return '{}-pyxb{}-{}'.format(sha1_checker.hexdigest(),
+                                 getattr(pyxb, '__version__', 'unknown'),
+                                 sys.implementation.cache_tag)
+
+
+def generate_binding_source(xsd_data: str) -> str:
+    """
+    Runs the PyXB code generator over an XSD
+    :param xsd_data: str - XSD text
+    :return: Python source of the binding module
+    """
+    from pyxb.binding import generate
+    return generate.GeneratePython(schema_text=xsd_data)
+
+
+def load_binding_module(xsd_data: str,
+                        filename: str,
+                        cache_dir: typing.Optional[str] = None,
+                        module_name: str = 'repository_module') -> ModuleType:
+    """
+    Returns the PyXB binding module for an XSD, generating it only when no usable cached copy exists
+    The cache holds the generated source (for inspection) and its marshalled code object (for loading)
+    :param xsd_data: str - XSD text
+    :param filename: str - Name reported in tracebacks for freshly generated code
+    :param cache_dir: str - Directory holding cached bindings, or None to disable caching
+    :param module_name: str - Name given to the resulting module
+    :return: module with the binding executed into it
+    """
+    code = None
+    source_path = None
+    if cache_dir:
+        key = binding_cache_key(xsd_data)
+        source_path = os.path.join(cache_dir, key + '.py')
+        code_path = os.path.join(cache_dir, key + '.marshal')
+        try:
+            with open(code_path, 'rb') as fp:
+                code = marshal.load(fp)
+        except (OSError, EOFError, ValueError, TypeError):
+            code = None
+
+    if cache_dir:
+        timings.cache('bindings', hit=code is not None)
+    if code is None:
+        with timings.phase('binding_generation', nbytes=len(xsd_data)):
+            binding_source = generate_binding_source(xsd_data)
+            code = compile(source=binding_source, filename=source_path or filename, mode='exec')
+        if cache_dir:
+            # noinspection PyUnboundLocalVariable
+            atomic_write(source_path, binding_source.encode('utf-8'))
+            # noinspection PyUnboundLocalVariable
+            atomic_write(code_path, marshal.dumps(code))
+
+    module = ModuleType(module_name)
+    if source_path is not None:
+        module.__file__ = source_path
+    exec(code, module.__dict__)
+    return module
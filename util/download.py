@@ -0,0 +1,392 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse, request
+from urllib.error import HTTPError
+from util.fileutil import atomic_write, exclusive_lock
+from util.timings import timings
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# how many bytes may be received between two journal updates
+JOURNAL_INTERVAL = 1024 * 1024
+DEFAULT_MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+
+class RangeNotSupported(Exception):
+    """
+    Raised by a segment fetch when the server answers a Range request with something other than 206
+    """
+
+
+def copy_stream(source: typing.BinaryIO,
+                target: typing.BinaryIO,
+                hasher=None,
+                offset: int = 0,
+                expected_size: typing.Optional[int] = None,
+                chunk_size: int = DEFAULT_CHUNK_SIZE,
+                progress: typing.Optional[typing.Callable[[int], None]] = None,
+                sink=None) -> int:
+    """
+    Copies source into target in fixed-size chunks, feeding the hasher on the way
+    :param source: file-like object being read, usually an HTTP response
+    :param target: file-like object being written
+    :param hasher: hashlib object updated with every chunk, or None
+    :param offset: number of bytes already present in target before the copy started
+    :param expected_size: int - total number of bytes expected; the copy aborts as soon as it is exceeded
+    :param chunk_size: int - size of each read
+    :param progress: callable invoked with the running byte count after every write, or None
+    :param sink: object whose feed() method receives every chunk after it has been written, or None
+    :return: total number of bytes in target (offset included)
+    """
+    received = offset
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        received += len(chunk)
+        if expected_size is not None and received > expected_size:
+            raise ValueError('Received more than the expected {} bytes'.format(expected_size))
+        if hasher is not None:
+            timings.hash_update(hasher, chunk)
+        target.write(chunk)
+        if sink is not None:
+            sink.feed(chunk)
+        if progress is not None:
+            progress(received)
+    return received
+
+
+def verify_download(received: int, hasher, expected_size: typing.Optional[int], checksum_value: str) -> None:
+    """
+    Checks the outcome of a download against the repository metadata
+    :param received: int - number of bytes received
+    :param hasher: hashlib object fed with all received bytes
+    :param expected_size: int - expected number of bytes, or None to skip the size check
+    :param checksum_value: str - expected hex digest
+    :rtype: None
+    """
+    if expected_size is not None and received != expected_size:
+        raise ValueError('Received {} bytes, expected {}'.format(received, expected_size))
+    if hasher.hexdigest() != checksum_value:
+        raise ValueError('{} checksum mismatch: got {}, expected {}'.format(hasher.name, hasher.hexdigest(),
+                                                                            checksum_value))
+
+
+def _read_journal(journal_path: str) -> typing.Optional[dict]:
+    try:
+        with open(journal_path, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_journal(journal_path: str, journal: dict) -> None:
+    atomic_write(journal_path, json.dumps(journal).encode('utf-8'))
+
+
+def _hash_prefix(path: str, length: int, hasher, chunk_size: int = DEFAULT_CHUNK_SIZE, sink=None) -> None:
+    with open(path, 'rb') as fp:
+        remaining = length
+        while remaining > 0:
+            chunk = fp.read(min(chunk_size, remaining))
+            if not chunk:
+                raise ValueError('Partial download is shorter than its journal claims')
+            timings.hash_update(hasher, chunk)
+            if sink is not None:
+                sink.feed(chunk)
+            remaining -= len(chunk)
+
+
+def resume_download(opener: request.OpenerDirector,
+                    req: request.Request,
+                    size: typing.Optional[int],
+                    checksum_type: str,
+                    checksum_value: str,
+                    download_dir: str,
+                    chunk_size: int = DEFAULT_CHUNK_SIZE,
+                    sink=None) -> typing.BinaryIO:
+    """
+    Downloads an archive into download_dir, picking up where an earlier interrupted attempt stopped
+    Bytes go to "<checksum>.part"; "<checksum>.journal" records how many of them are on disk and the validator
+    (ETag / Last-Modified) of the response they came from. hashlib state cannot be persisted, so on resume the
+    partial file is re-hashed from disk before "Range: bytes=N-" is requested for the rest.
+    Callers must hold the "<checksum>.lock" lock of download_dir (see download_archive).
+    :param opener: OpenerDirector used to run the request
+    :param req: Request pointing at the archive
+    :param size: int - expected archive size in bytes
+    :param checksum_type: str - hashlib algorithm name, e.g. 'sha1'
+    :param checksum_value: str - expected hex digest
+    :param download_dir: str - directory holding partial and completed downloads
+    :param chunk_size: int - size of each read
+    :param sink: object with feed(data) and reset() methods that is handed the archive bytes in order, or None
+    :return: file object of the verified archive ("<checksum><ext>" in download_dir), positioned at its start
+    """
+    os.makedirs(download_dir, exist_ok=True)
+    base_path = os.path.join(download_dir, checksum_value)
+    part_path = base_path + '.part'
+    journal_path = base_path + '.journal'
+    final_path = base_path + os.path.splitext(parse.urlparse(req.full_url).path)[1]
+
+    journal = _read_journal(journal_path)
+    if journal is None or not os.path.isfile(part_path) or journal.get('size') != size or \
+            journal.get('checksum_type') != checksum_type or journal.get('checksum_value') != checksum_value:
+        journal = {
+            'url': req.full_url,
+            'size': size,
+            'checksum_type': checksum_type,
+            'checksum_value': checksum_value,
+            'received': 0,
+            'validator': None,
+        }
+    with open(part_path, 'ab') as target:
+        # anything past the journaled count may be a torn write
+        received = min(journal['received'], target.tell())
+        target.truncate(received)
+
+    hasher = hashlib.new(checksum_type)
+    if sink is not None:
+        # the sink may have seen part of an earlier attempt; replay everything from the first byte
+        sink.reset()
+    _hash_prefix(part_path, received, hasher, chunk_size, sink)
+
+    if size is None or received < size:
+        if received:
+            req.add_header('Range', 'bytes={}-'.format(received))
+            if journal['validator']:
+                req.add_header('If-range', journal['validator'])
+        try:
+            with opener.open(req) as conn, open(part_path, 'r+b') as target:
+                if received and conn.code != 206:
+                    # server ignored the range or the resource changed since the last attempt: start over
+                    hasher = hashlib.new(checksum_type)
+                    received = 0
+                    target.truncate(0)
+                    if sink is not None:
+                        sink.reset()
+                target.seek(received)
+                journal['validator'] = conn.headers.get('ETag') or conn.headers.get('Last-Modified')
+                journaled = [received]
+
+                def checkpoint(count: int) -> None:
+                    if count - journaled[0] >= JOURNAL_INTERVAL:
+                        target.flush()
+                        journal['received'] = journaled[0] = count
+                        _write_journal(journal_path, journal)
+
+                try:
+                    received = copy_stream(conn, target, hasher=hasher, offset=received, expected_size=size,
+                                           chunk_size=chunk_size, progress=checkpoint, sink=sink)
+                finally:
+                    target.flush()
+                    journal['received'] = target.tell()
+                    _write_journal(journal_path, journal)
+        except HTTPError as e:
+            if e.code == 416:
+                # journal points past the end of the resource; make the next attempt start from zero
+                if os.path.exists(journal_path):
+                    os.remove(journal_path)
+            raise
+        finally:
+            for header in ('Range', 'If-range'):
+                if req.has_header(header):
+                    req.remove_header(header)
+
+    if size is not None and received < size:
+        # connection dropped early: keep the partial file and journal for the next attempt
+        raise ConnectionError('Transfer interrupted after {} of {} bytes'.format(received, size))
+    try:
+        verify_download(received, hasher, size, checksum_value)
+    except ValueError:
+        # a complete but corrupt download cannot be resumed
+        os.remove(part_path)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        raise
+    os.replace(part_path, final_path)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+    return open(final_path, 'rb')
+
+
+def _fetch_segment(opener: request.OpenerDirector,
+                   url: str,
+                   headers: dict,
+                   path: str,
+                   first: int,
+                   last: int,
+                   chunk_size: int) -> int:
+    segment_req = request.Request(url, headers=headers, method='GET')
+    segment_req.add_header('Range', 'bytes={}-{}'.format(first, last))
+    with opener.open(segment_req) as conn, open(path, 'r+b') as target:
+        if conn.code != 206:
+            raise RangeNotSupported('Server does not honour byte ranges for {}'.format(url))
+        target.seek(first)
+        received = copy_stream(conn, target, expected_size=last - first + 1, chunk_size=chunk_size)
+    if received != last - first + 1:
+        raise ConnectionError('Segment {}-{} interrupted after {} bytes'.format(first, last, received))
+    return received
+
+
+def segmented_download(opener: request.OpenerDirector,
+                       req: request.Request,
+                       size: int,
+                       checksum_type: str,
+                       checksum_value: str,
+                       download_dir: str,
+                       segments: int,
+                       min_segment_size: int = DEFAULT_MIN_SEGMENT_SIZE,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE) -> typing.BinaryIO:
+    """
+    Downloads an archive over several concurrent Range requests
+    The target file is preallocated and every segment is written at its own offset by a separate worker; size and
+    checksum are verified over the assembled file once all segments are in.
+    Falls back to resume_download when the archive is too small to split or the server ignores byte ranges.
+    Callers must hold the "<checksum>.lock" lock of download_dir (see download_archive).
+    :param opener: OpenerDirector used to run the requests
+    :param req: Request pointing at the archive
+    :param size: int - expected archive size in bytes
+    :param checksum_type: str - hashlib algorithm name, e.g. 'sha1'
+    :param checksum_value: str - expected hex digest
+    :param download_dir: str - directory holding partial and completed downloads
+    :param segments: int - maximum number of concurrent connections
+    :param min_segment_size: int - segments are never made smaller than this many bytes
+    :param chunk_size: int - size of each read
+    :return: file object of the verified archive ("<checksum><ext>" in download_dir), positioned at its start
+    """
+    count = min(segments, size // max(min_segment_size, 1))
+    base_path = os.path.join(download_dir, checksum_value)
+    if count <= 1 or os.path.exists(base_path + '.journal'):
+        # not worth splitting, or a single-stream attempt is already halfway through
+        return resume_download(opener, req, size, checksum_type, checksum_value, download_dir, chunk_size)
+
+    os.makedirs(download_dir, exist_ok=True)
+    segments_path = base_path + '.segments'
+    final_path = base_path + os.path.splitext(parse.urlparse(req.full_url).path)[1]
+    with open(segments_path, 'wb') as target:
+        target.truncate(size)
+
+    bounds = [size * index // count for index in range(count + 1)]
+    headers = {name: value for name, value in req.header_items() if name.lower() not in ('range', 'if-range')}
+    try:
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            futures = [executor.submit(_fetch_segment, opener, req.full_url, headers, segments_path,
+                                       bounds[index], bounds[index + 1] - 1, chunk_size)
+                       for index in range(count)]
+            try:
+                received = sum(future.result() for future in futures)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        hasher = hashlib.new(checksum_type)
+        _hash_prefix(segments_path, size, hasher, chunk_size)
+        verify_download(received, hasher, size, checksum_value)
+    except RangeNotSupported:
+        os.remove(segments_path)
+        return resume_download(opener, req, size, checksum_type, checksum_value, download_dir, chunk_size)
+    except BaseException:
+        os.remove(segments_path)
+        raise
+    os.replace(segments_path, final_path)
+    return open(final_path, 'rb')
+
+
+def _completed_download(final_path: str,
+                        size: typing.Optional[int],
+                        checksum_type: str,
+                        checksum_value: str,
+                        chunk_size: int,
+                        sink=None) -> typing.Optional[typing.BinaryIO]:
+    """
+    Picks up an archive another run has already downloaded into place
+    :return: file object of the verified archive positioned at its start, or None if there is no valid one
+    """
+    try:
+        actual_size = os.path.getsize(final_path)
+    except OSError:
+        return None
+    if size is not None and actual_size != size:
+        return None
+    hasher = hashlib.new(checksum_type)
+    if sink is not None:
+        sink.reset()
+    _hash_prefix(final_path, actual_size, hasher, chunk_size, sink)
+    if hasher.hexdigest() != checksum_value:
+        return None
+    return open(final_path, 'rb')
+
+
+def download_archive(opener: request.OpenerDirector,
+                     req: request.Request,
+                     size: typing.Optional[int],
+                     checksum_type: str,
+                     checksum_value: str,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE,
+                     download_dir: typing.Optional[str] = None,
+                     segments: int = 1,
+                     min_segment_size: int = DEFAULT_MIN_SEGMENT_SIZE,
+                     sink=None) -> typing.BinaryIO:
+    """
+    Streams an archive to disk, verifying size and checksum on the way
+    Peak memory use is bounded by chunk_size regardless of the archive size
+    :param opener: OpenerDirector used to run the request
+    :param req: Request pointing at the archive
+    :param size: int - expected archive size in bytes
+    :param checksum_type: str - hashlib algorithm name, e.g. 'sha1'
+    :param checksum_value: str - expected hex digest
+    :param chunk_size: int - size of each read
+    :param download_dir: str - directory for resumable downloads, or None to use an anonymous temporary file;
+        concurrent downloads of the same archive into one directory are serialised by a "<checksum>.lock" file
+    :param segments: int - number of concurrent Range connections; only used together with download_dir
+    :param min_segment_size: int - segments are never made smaller than this many bytes
+    :param sink: object with feed(data) and reset() methods that is handed the archive bytes in order, or None;
+        segments arrive out of order, so a sink disables segmented downloads
+    :return: file holding the verified archive, positioned at its start
+    """
+    if download_dir is not None:
+        os.makedirs(download_dir, exist_ok=True)
+        base_path = os.path.join(download_dir, checksum_value)
+        # runs sharing download_dir take turns: the partial files of an archive have a single writer, and whoever
+        # waited finds the archive completed by the previous holder of the lock
+        with exclusive_lock(base_path + '.lock'):
+            fileobj = _completed_download(base_path + os.path.splitext(parse.urlparse(req.full_url).path)[1],
+                                          size, checksum_type, checksum_value, chunk_size, sink)
+            if fileobj is not None:
+                return fileobj
+            if segments > 1 and size and sink is None:
+                return segmented_download(opener, req, size, checksum_type, checksum_value, download_dir, segments,
+                                          min_segment_size, chunk_size)
+            return resume_download(opener, req, size, checksum_type, checksum_value, download_dir, chunk_size,
+                                   sink)
+
+    hasher = hashlib.new(checksum_type)
+    target = tempfile.TemporaryFile()
+    try:
+        with opener.open(req) as conn:
+            received = copy_stream(conn, target, hasher=hasher, expected_size=size, chunk_size=chunk_size,
+                                   sink=sink)
+        verify_download(received, hasher, size, checksum_value)
+    except BaseException:
+        target.close()
+        raise
+    target.seek(0)
+    return target
@@ -0,0 +1,200 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Every archive is inflated once into "<root>/<checksum>"; installations are then assembled from that tree by
+reflinking (copy-on-write clones), hard linking or, as a last resort, copying its files. Hard-linked installations
+share their files with the store, which is why extraction never writes into an existing file that has other links.
+"""
+import errno
+import os
+import shutil
+import tempfile
+import typing
+from util.manifest import MANIFEST_NAME, manifest_intact, read_manifest, write_manifest
+from util.timings import timings
+from util.zipfile_extract_perms import PERMS_PRESERVE_SAFE
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+LINK_METHODS = ('reflink', 'hardlink', 'copy')
+
+
+def _reflink(source: str, target: str) -> None:
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copymode(source, target)
+
+
+def clone_file(source: str, target: str, methods: typing.Sequence[str] = LINK_METHODS) -> str:
+    """
+    Creates target with the contents of source, using the first of the given methods that works
+    :param source: str - existing file
+    :param target: str - path to create; must not exist
+    :param methods: sequence of 'reflink', 'hardlink' and 'copy', in order of preference
+    :return: the method that was used
+    """
+    for method in methods:
+        try:
+            if method == 'reflink':
+                _reflink(source, target)
+            elif method == 'hardlink':
+                os.link(source, target)
+            elif method == 'copy':
+                shutil.copyfile(source, target)
+                shutil.copymode(source, target)
+            else:
+                raise ValueError('Unknown link method {}'.format(method))
+        except OSError:
+            if os.path.lexists(target):
+                os.remove(target)
+            if method == methods[-1]:
+                raise
+        else:
+            return method
+    raise ValueError('No link method given')
+
+
+class ExtractedStore(object):
+    """
+    Shared store of inflated archives, keyed by archive checksum
+    """
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, checksum_value: str) -> str:
+        return os.path.join(self.root, checksum_value)
+
+    def ensure(self, archive, version: str, checksum: dict, license_id: typing.Optional[str], workers: int = 1,
+               stream_extractor=None) -> str:
+        """
+        Makes sure an archive is available in inflated form, extracting it if needed
+        :param archive: ZipFileMod - the verified archive
+        :param version: str - platform tools version contained in the archive
+        :param checksum: dict - {'type': ..., 'value': ...} of the archive
+        :param license_id: str - id of the license the version is distributed under
+        :param workers: int - number of concurrent extraction workers
+        :param stream_extractor: ZipStreamExtractor - members already inflated during the download, if any
+        :return: path of the inflated tree
+        """
+        path = self.path_for(checksum['value'])
+        manifest = read_manifest(path)
+        if manifest is not None and manifest.get('checksum') == checksum and manifest_intact(path, manifest):
+            # the modification time orders entries for pruning
+            os.utime(path)
+            timings.cache('extracted', hit=True)
+            return path
+        timings.cache('extracted', hit=False)
+        stage = tempfile.mkdtemp(prefix='.extracting-', dir=self.root)
+        try:
+            published = False
+            if stream_extractor is not None and stream_extractor.complete:
+                try:
+                    with timings.phase('publish'):
+                        stream_extractor.publish(archive, stage, preserve_permissions=PERMS_PRESERVE_SAFE)
+                    published = True
+                except ValueError:
+                    # publish() rejects a mismatch before moving anything into the stage
+                    stream_extractor.discard()
+            if not published:
+                with timings.phase('extract', nbytes=sum(x.file_size for x in archive.infolist())):
+                    archive.extractall(path=stage, preserve_permissions=PERMS_PRESERVE_SAFE, workers=workers)
+            write_manifest(stage, version=version, checksum=checksum, license_id=license_id,
+                           files=archive.member_manifest())
+            # mkdtemp creates the directory accessible to its owner only
+            os.chmod(stage, 0o755)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(stage, path)
+        except BaseException:
+            shutil.rmtree(stage, ignore_errors=True)
+            raise
+        return path
+
+    @staticmethod
+    def install(store_path: str,
+                target_dir: str,
+                previous_files: typing.Optional[typing.Dict[str, dict]] = None,
+                methods: typing.Sequence[str] = LINK_METHODS) -> typing.Dict[str, int]:
+        """
+        Builds an installation from an inflated tree
+        Files already identical to the store (same file, or unchanged according to previous_files) are left alone,
+        files listed in previous_files that the new version no longer has are removed.
+        :param store_path: str - path returned by ensure
+        :param target_dir: str - directory to install into
+        :param previous_files: dict - "files" of the manifest of the installation being replaced, if any
+        :param methods: sequence of link methods in order of preference, see clone_file
+        :return: number of files installed per method
+        """
+        files = read_manifest(store_path)['files']
+        methods = list(methods)
+        used = dict()
+        for dir_path, dir_names, file_names in os.walk(store_path):
+            relative_dir = os.path.relpath(dir_path, store_path)
+            target_path = os.path.normpath(os.path.join(target_dir, relative_dir))
+            os.makedirs(target_path, exist_ok=True)
+            for file_name in file_names:
+                if relative_dir == '.' and file_name == MANIFEST_NAME:
+                    continue
+                name = '/'.join(os.path.normpath(os.path.join(relative_dir, file_name)).split(os.sep))
+                source = os.path.join(dir_path, file_name)
+                target = os.path.join(target_path, file_name)
+                if os.path.isfile(target):
+                    if os.path.samefile(source, target) or \
+                            (previous_files is not None and name in files and
+                             previous_files.get(name) == files[name] and
+                             os.path.getsize(target) == files[name]['size']):
+                        continue
+                temp_target = target + '.nsaptr-tmp'
+                if os.path.lexists(temp_target):
+                    os.remove(temp_target)
+                method = clone_file(source, temp_target, methods)
+                # methods that failed once will fail for the rest of the tree as well
+                methods = methods[methods.index(method):]
+                os.replace(temp_target, target)
+                used[method] = used.get(method, 0) + 1
+        for name in set(previous_files or ()) - set(files):
+            stale = os.path.join(target_dir, *name.split('/'))
+            if os.path.isfile(stale):
+                os.remove(stale)
+        return used
+
+    def prune(self, keep: int, protect: typing.Iterable[str] = ()) -> typing.List[str]:
+        """
+        Removes all but the "keep" most recently used inflated trees
+        Installations built from hard links or reflinks stay intact; they merely stop sharing storage.
+        :param keep: int - number of trees to keep
+        :param protect: checksums that must not be removed
+        :return: checksums of the removed trees
+        """
+        protect = set(protect)
+        entries = [name for name in os.listdir(self.root)
+                   if not name.startswith('.') and os.path.isdir(self.path_for(name))]
+        entries.sort(key=lambda name: os.path.getmtime(self.path_for(name)), reverse=True)
+        removed = []
+        for name in entries[max(keep, 0):]:
+            if name in protect:
+                continue
+            shutil.rmtree(self.path_for(name))
+            removed.append(name)
+        return removed
@@ -0,0 +1,117 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import contextlib
+import hashlib
+import os
+import tempfile
+import typing
+from util.timings import timings
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+
+def atomic_write(path: str, data: typing.ByteString, mode: typing.Optional[int] = None) -> None:
+    """
+    Writes data to path so that readers either see the old content or the new content, never a partial file
+    :param path: str - Destination file path; parent directories are created if necessary
+    :param data: byte string - Content to be written
+    :param mode: int - permission bits for the file, or None to keep the owner-only default of temporary files
+    :rtype: None
+    """
+    directory = os.path.dirname(path) or os.path.curdir
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+@contextlib.contextmanager
+def exclusive_lock(path: str) -> typing.Iterator[None]:
+    """
+    Holds an exclusive advisory lock on path (created if necessary) for the duration of the block
+    Other processes, and other threads opening the same path, wait until the lock is released. The lock file is left
+    in place, as removing it would let a waiting process lock a file nobody else sees any more.
+    Without fcntl (Windows) the block runs unlocked.
+    :param path: str - lock file path
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def hash_file(path: str, checksum_type: str) -> str:
+    """
+    :param path: str - file to hash
+    :param checksum_type: str - hashlib algorithm name
+    :return: hex digest of the file's content
+    """
+    hasher = hashlib.new(checksum_type)
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            timings.hash_update(hasher, chunk)
+    return hasher.hexdigest()
+
+
+def file_identity(stat: os.stat_result) -> dict:
+    """
+    :return: the size and modification time recorded when a file's checksum is verified, see verify_file
+    """
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def verify_file(path: str,
+                checksum_type: str,
+                checksum_value: str,
+                size: typing.Optional[int] = None,
+                identity: typing.Optional[dict] = None) -> typing.Optional[os.stat_result]:
+    """
+    Checks a file against its expected size and checksum
+    A file whose size and modification time still match those recorded (file_identity) when it was last verified is
+    trusted without hashing it again.
+    :param path: str - file to check
+    :param checksum_type: str - hashlib algorithm name
+    :param checksum_value: str - expected hex digest
+    :param size: int - expected size in bytes, or None
+    :param identity: dict - file_identity recorded when the file was verified against this checksum, or None
+    :return: stat of the file, or None if it is missing or does not match
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if size is not None and stat.st_size != size:
+        return None
+    if identity is not None and identity.get('size') == stat.st_size and identity.get('mtime_ns') == stat.st_mtime_ns:
+        return stat
+    return stat if hash_file(path, checksum_type) == checksum_value else None
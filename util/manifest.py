@@ -0,0 +1,133 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import json
+import os
+import time
+import typing
+from util.fileutil import atomic_write
+from util.versionindex import version_key
+
+MANIFEST_NAME = '.nsaptr-manifest.json'
+SNAPSHOT_NAME = 'repository-snapshot.json'
+
+
+def _read_json(path: str) -> typing.Optional[dict]:
+    try:
+        with open(path, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def read_manifest(directory: str) -> typing.Optional[dict]:
+    """
+    Loads the install manifest of an extraction directory
+    :param directory: str - extraction base directory
+    :return: manifest dict, or None if the directory holds no readable manifest
+    """
+    return _read_json(os.path.join(directory, MANIFEST_NAME))
+
+
+def write_manifest(directory: str,
+                   version: str,
+                   checksum: dict,
+                   license_id: typing.Optional[str],
+                   files: typing.Dict[str, dict]) -> dict:
+    """
+    Records what was installed into an extraction directory
+    :param directory: str - extraction base directory
+    :param version: str - installed platform tools version
+    :param checksum: dict - {'type': ..., 'value': ...} of the installed archive
+    :param license_id: str - id of the license the version is distributed under
+    :param files: dict - per-file {'size': ..., 'crc32': ...} keyed by archive member name
+    :return: the manifest that was written
+    """
+    manifest = {
+        'version': version,
+        'checksum': checksum,
+        'license': license_id,
+        'installed_at': time.time(),
+        'files': files,
+    }
+    atomic_write(os.path.join(directory, MANIFEST_NAME), json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def manifest_intact(directory: str, manifest: dict) -> bool:
+    """
+    Cheap integrity check of an installation: every recorded file must exist with its recorded size
+    :param directory: str - extraction base directory
+    :param manifest: dict - manifest as returned by read_manifest
+    :rtype: bool
+    """
+    for name, entry in manifest.get('files', {}).items():
+        try:
+            if os.stat(os.path.join(directory, *name.split('/'))).st_size != entry['size']:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def read_snapshot(cache_dir: str, host_os: str, max_age: float) -> typing.Optional[dict]:
+    """
+    Loads the summary of the last repository resolution, if it is recent enough to be relied upon
+    :param cache_dir: str - cache directory
+    :param host_os: str - repository host-os name the snapshot must have been taken for
+    :param max_age: float - maximum snapshot age in seconds
+    :return: snapshot dict, or None
+    """
+    snapshot = _read_json(os.path.join(cache_dir, SNAPSHOT_NAME))
+    if snapshot is None or snapshot.get('host_os') != host_os or \
+            not 0 <= time.time() - snapshot.get('fetched_at', 0) <= max_age:
+        return None
+    return snapshot
+
+
+def write_snapshot(cache_dir: str, host_os: str, archives: typing.Dict[str, dict]) -> None:
+    """
+    Stores a summary of the versions available for this host, for later up-to-date checks
+    :param cache_dir: str - cache directory
+    :param host_os: str - repository host-os name the archives were selected for
+    :param archives: dict - archive data keyed by version, as built by nsaptr
+    :rtype: None
+    """
+    snapshot = {
+        'fetched_at': time.time(),
+        'host_os': host_os,
+        'versions': {version: {'checksum': data['checksum'], 'license': data['license']}
+                     for version, data in archives.items()},
+    }
+    atomic_write(os.path.join(cache_dir, SNAPSHOT_NAME), json.dumps(snapshot, sort_keys=True).encode('utf-8'))
+
+
+def is_up_to_date(manifest: dict, snapshot: dict, keep_while_available: bool) -> bool:
+    """
+    Decides, from local data only, whether an installation needs no further work
+    :param manifest: dict - manifest of the installation
+    :param snapshot: dict - recent repository snapshot
+    :param keep_while_available: bool - whether any still-published version is good enough
+    :rtype: bool
+    """
+    versions = snapshot.get('versions', {})
+    installed = versions.get(manifest.get('version'))
+    if installed is None or installed['checksum'] != manifest.get('checksum'):
+        return False
+    if keep_while_available:
+        return True
+    latest = max(versions, key=version_key)
+    return latest == manifest['version']
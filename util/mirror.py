@@ -0,0 +1,164 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+A mirror is a local directory laid out like URL_GOOGLE_SDK_SITE: every archive sits at the path its URL has below
+the site, next to the repository XML, its XSD and the SdkRepoConstants.java they were resolved with (stored as plain
+text, not base64).
+"""
+import json
+import os
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse, request
+from util.download import download_archive, DEFAULT_MIN_SEGMENT_SIZE
+from util.extractedstore import clone_file
+from util.fileutil import atomic_write, file_identity, verify_file
+
+MIRROR_INDEX_NAME = '.nsaptr-mirror.json'
+# suffix of the directory next to the mirror that holds interrupted downloads when there is no archive store
+PARTIAL_SUFFIX = '.nsaptr-partial'
+CONSTANTS_NAME = 'SdkRepoConstants.java'
+
+
+def mirror_relative_path(site_url: str, url: str) -> typing.Optional[str]:
+    """
+    Tells where an archive belongs inside a mirror
+    :param site_url: str - URL_GOOGLE_SDK_SITE
+    :param url: str - archive URL as given in the repository, relative to the site or absolute
+    :return: '/'-separated path below the mirror root, or None if the URL lies outside the site
+    """
+    absolute = parse.urljoin(site_url, url)
+    if not absolute.startswith(site_url):
+        return None
+    relative = parse.unquote(parse.urlparse(absolute[len(site_url):]).path)
+    parts = relative.split('/')
+    if not relative or any(part in ('', '.', '..') for part in parts):
+        return None
+    return relative
+
+
+def _read_index(mirror_dir: str) -> dict:
+    try:
+        with open(os.path.join(mirror_dir, MIRROR_INDEX_NAME), 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _partial_dir(mirror_dir: str) -> str:
+    """
+    Directory for interrupted downloads when there is no archive store: next to the mirror rather than inside the tree
+    it publishes, and on the same file system so completed archives can be renamed into place
+    """
+    mirror_dir = os.path.abspath(mirror_dir)
+    return os.path.join(os.path.dirname(mirror_dir), '.{}{}'.format(os.path.basename(mirror_dir), PARTIAL_SUFFIX))
+
+
+def _index_entry(path: str, archive: dict) -> dict:
+    return dict(file_identity(os.stat(path)), checksum=archive['checksum'])
+
+
+def _present(path: str, archive: dict, entry: typing.Optional[dict]) -> bool:
+    return verify_file(path, archive['checksum']['type'], archive['checksum']['value'], archive['size'],
+                       entry if entry is not None and entry.get('checksum') == archive['checksum'] else None) \
+        is not None
+
+
+def _sync_archive(opener: request.OpenerDirector,
+                  mirror_dir: str,
+                  archive: dict,
+                  entry: typing.Optional[dict],
+                  archive_store,
+                  segments: int,
+                  min_segment_size: int) -> bool:
+    target = os.path.join(mirror_dir, *archive['path'].split('/'))
+    if _present(target, archive, entry):
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    stored = archive_store.lookup(archive['checksum']['type'], archive['checksum']['value'], archive['size']) \
+        if archive_store is not None else None
+    if stored is None:
+        req = request.Request(archive['url'], method='GET')
+        req.cacheable = False
+        # partial downloads never appear inside the published tree
+        fileobj = download_archive(opener, req,
+                                   size=archive['size'],
+                                   checksum_type=archive['checksum']['type'],
+                                   checksum_value=archive['checksum']['value'],
+                                   download_dir=archive_store.root if archive_store is not None
+                                   else _partial_dir(mirror_dir),
+                                   segments=segments,
+                                   min_segment_size=min_segment_size)
+        fileobj.close()
+        if archive_store is None:
+            os.replace(fileobj.name, target)
+            return True
+        stored = archive_store.add(fileobj.name, archive['checksum']['type'], archive['checksum']['value'])
+    temp_target = target + '.nsaptr-tmp'
+    if os.path.lexists(temp_target):
+        os.remove(temp_target)
+    clone_file(stored, temp_target)
+    os.replace(temp_target, target)
+    return True
+
+
+def sync_mirror(opener: request.OpenerDirector,
+                mirror_dir: str,
+                archives: typing.List[dict],
+                metadata: typing.Dict[str, bytes],
+                workers: int = 4,
+                archive_store=None,
+                segments: int = 1,
+                min_segment_size: int = DEFAULT_MIN_SEGMENT_SIZE) -> typing.Tuple[typing.List[str],
+                                                                                  typing.Dict[str, Exception]]:
+    """
+    Brings a mirror up to date
+    Archives already present with the right size and checksum are left alone; an index of verified sizes and
+    modification times spares re-hashing them on every sync. The metadata files are only replaced once every
+    archive is in place, so the mirror never lists archives it does not have.
+    :param opener: OpenerDirector used to run the requests
+    :param mirror_dir: str - mirror root directory
+    :param archives: list of {'url', 'path', 'size', 'checksum'} dicts, 'path' as from mirror_relative_path
+    :param metadata: dict - contents of the repository XML, XSD and constants files keyed by mirror path
+    :param workers: int - number of archives transferred concurrently
+    :param archive_store: ArchiveStore - local archives to copy from instead of downloading, which also keeps what is
+        downloaded; None to download straight into the mirror
+    :param segments: int - number of concurrent Range connections per archive
+    :param min_segment_size: int - segments are never made smaller than this many bytes
+    :return: (mirror paths of the archives that were fetched, exceptions keyed by the mirror paths that failed)
+    """
+    os.makedirs(mirror_dir, exist_ok=True)
+    index = _read_index(mirror_dir)
+    unique = list({archive['path']: archive for archive in archives}.values())
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [(archive, executor.submit(_sync_archive, opener, mirror_dir, archive, index.get(archive['path']),
+                                             archive_store, segments, min_segment_size))
+                   for archive in unique]
+    fetched = []
+    failed = dict()
+    for archive, future in futures:
+        if future.exception() is not None:
+            failed[archive['path']] = future.exception()
+            continue
+        if future.result():
+            fetched.append(archive['path'])
+        index[archive['path']] = _index_entry(os.path.join(mirror_dir, *archive['path'].split('/')), archive)
+    atomic_write(os.path.join(mirror_dir, MIRROR_INDEX_NAME), json.dumps(index, sort_keys=True).encode('utf-8'))
+    if not failed:
+        for path, data in metadata.items():
+            # served to other machines, so readable by everyone
+            atomic_write(os.path.join(mirror_dir, *path.split('/')), data, mode=0o644)
+    return fetched, failed
@@ -0,0 +1,90 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import typing
+from io import BytesIO
+from xml.etree.ElementTree import iterparse
+
+
+def _child_text(element, tag: str, default: typing.Optional[str] = None) -> typing.Optional[str]:
+    child = element.find(tag)
+    return child.text.strip() if child is not None and child.text is not None else default
+
+
+def parse_repository(xml_data: typing.Union[bytes, typing.BinaryIO],
+                     xmlns: str,
+                     root_name: str,
+                     node_name: str) -> typing.Tuple[typing.List[dict], typing.Dict[str, str]]:
+    """
+    Extracts platform tool entries and licenses from a repository document in a single streaming pass
+    Each top-level element is discarded as soon as it has been read, so memory use does not grow with the document
+    :param xml_data: bytes or binary file object holding the repository XML
+    :param xmlns: str - namespace the root element must belong to
+    :param root_name: str - local name the root element must have (NODE_SDK_REPOSITORY)
+    :param node_name: str - local name of the elements to extract (NODE_PLATFORM_TOOL)
+    :return: tuple of the platform tool records and a dict of license texts keyed by license id
+        Records look like {'version': '23.1.0', 'revision': (23, 1, 0), 'license': 'android-sdk-license',
+        'archives': [{'size': 1234, 'checksum': {'type': 'sha1', 'value': '...'}, 'url': '...', 'host_os': 'linux'}]}
+    """
+    if isinstance(xml_data, (bytes, bytearray)):
+        xml_data = BytesIO(xml_data)
+    ns = '{' + xmlns + '}'
+    node_tag = ns + node_name
+    license_tag = ns + 'license'
+
+    records = list()
+    licenses = dict()
+    root = None
+    depth = 0
+    for event, element in iterparse(xml_data, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                if element.tag != ns + root_name:
+                    raise ValueError('Unexpected repository root element {}'.format(element.tag))
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if element.tag == node_tag:
+            revision = element.find(ns + 'revision')
+            numbers = tuple(int(_child_text(revision, ns + part, '0')) for part in ('major', 'minor', 'micro'))
+            uses_license = element.find(ns + 'uses-license')
+            archives = list()
+            for archive in element.iterfind(ns + 'archives/' + ns + 'archive'):
+                checksum = archive.find(ns + 'checksum')
+                archives.append({
+                    'size': int(_child_text(archive, ns + 'size')),
+                    'checksum': {
+                        'type': checksum.get('type'),
+                        'value': checksum.text.strip(),
+                    },
+                    'url': _child_text(archive, ns + 'url'),
+                    'host_os': _child_text(archive, ns + 'host-os'),
+                })
+            records.append({
+                'version': '{}.{}.{}'.format(*numbers),
+                'revision': numbers,
+                'license': uses_license.get('ref') if uses_license is not None else None,
+                'archives': archives,
+            })
+        elif element.tag == license_tag:
+            licenses[element.get('id')] = element.text or ''
+        root.remove(element)
+    if root is None:
+        raise ValueError('Empty repository document')
+    return records, licenses
@@ -13,38 +13,313 @@ Copyright 2016 adpoliak
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import http.client
+import json
+import os
+import ssl
+import threading
 import typing
+from hashlib import sha1
+from http.client import HTTPMessage
 from http.cookiejar import CookieJar
+from io import BytesIO
 from urllib import parse, request
+from urllib.error import URLError
+from util.fileutil import atomic_write
+from util.timings import timings
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe store of idle keep-alive connections, keyed by connection class and host
+    The TLS session of the last HTTPS connection to each host is kept as well, so that new connections to a host
+    that already has all of its pooled connections busy can resume it instead of doing a full handshake
+    Sessions can only be resumed through the SSLContext that negotiated them, so they are stored per context too
+    """
+    def __init__(self, max_idle_per_host: int = 8):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = dict()
+        self._sessions = dict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key: typing.Tuple[str, str]) -> typing.Optional[http.client.HTTPConnection]:
+        with self._lock:
+            idle = self._idle.get(key)
+            return idle.pop() if idle else None
+
+    def release(self, key: typing.Tuple[str, str], conn: http.client.HTTPConnection) -> None:
+        session = getattr(conn.sock, 'session', None)
+        with self._lock:
+            if session is not None:
+                self._sessions[key + (conn.sock.context,)] = session
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def session(self, key: typing.Tuple[str, str], context: ssl.SSLContext) -> typing.Optional[ssl.SSLSession]:
+        with self._lock:
+            return self._sessions.get(key + (context,))
+
+    def close(self) -> None:
+        with self._lock:
+            connections = [conn for idle in self._idle.values() for conn in idle]
+            self._idle.clear()
+        for conn in connections:
+            conn.close()
+
+
+default_pool = ConnectionPool()
+
+
+class _PooledResponse(http.client.HTTPResponse):
+    """
+    HTTPResponse that hands its connection back to the pool once the body has been read completely and closed
+    """
+    release_callback = None
+
+    def close(self):
+        complete = self.fp is None or (self.length == 0 and not self.chunked)
+        super().close()
+        callback, self.release_callback = self.release_callback, None
+        if callback is not None:
+            callback(complete)
+
+
+class _PooledHTTPSConnection(http.client.HTTPSConnection):
+    """
+    HTTPSConnection that offers a previously negotiated TLS session to the server when connecting
+    """
+    ssl_session = None
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host if self._tunnel_host else self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname, session=self.ssl_session)
+
+
+class _KeepAliveMixin(object):
+    """
+    Replacement for AbstractHTTPHandler.do_open that reuses pooled connections instead of forcing "Connection: close"
+    """
+    pool = default_pool
+
+    def do_open(self, http_class, req, **http_conn_args):
+        host = req.host
+        if not host:
+            raise URLError('no host given')
+        if req._tunnel_host:
+            # proxy tunnels are rare enough not to be worth pooling
+            # noinspection PyUnresolvedReferences
+            return super().do_open(http_class, req, **http_conn_args)
+        if http_class is http.client.HTTPSConnection:
+            http_class = _PooledHTTPSConnection
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers['Connection'] = 'keep-alive'
+        headers = {name.title(): val for name, val in headers.items()}
+
+        key = (http_class.__name__, host)
+        conn = self.pool.acquire(key)
+        timings.count('http_requests')
+        timings.count('connections_reused' if conn is not None else 'connections_opened')
+        # a pooled connection may have been dropped by the server in the meantime; only idempotent requests retry
+        retry = conn is not None and req.get_method() in ('GET', 'HEAD')
+        while True:
+            if conn is None:
+                conn = http_class(host, timeout=req.timeout, **http_conn_args)
+                if isinstance(conn, _PooledHTTPSConnection):
+                    conn.ssl_session = self.pool.session(key, conn._context)
+                # noinspection PyUnresolvedReferences
+                conn.set_debuglevel(self._debuglevel)
+            conn.response_class = _PooledResponse
+            try:
+                conn.request(req.get_method(), req.selector, req.data, headers,
+                             encode_chunked=req.has_header('Transfer-encoding'))
+                r = conn.getresponse()
+            except (OSError, http.client.HTTPException) as err:
+                conn.close()
+                if retry:
+                    timings.count('connections_opened')
+                    conn = None
+                    retry = False
+                    continue
+                if isinstance(err, OSError):
+                    raise URLError(err)
+                raise
+            break
+
+        def release(complete: bool) -> None:
+            # a connection with unread body data left on it cannot carry another request
+            if complete and not r.will_close:
+                self.pool.release(key, conn)
+            else:
+                conn.close()
+
+        r.release_callback = release
+
+        r.url = req.get_full_url()
+        r.msg = r.reason
+        return r
+
+
+class KeepAliveHTTPHandler(_KeepAliveMixin, request.HTTPHandler):
+    pass
+
+
+class KeepAliveHTTPSHandler(_KeepAliveMixin, request.HTTPSHandler):
+    """
+    HTTPSHandler whose connections all share one SSLContext, so pooled TLS sessions can be resumed by any of them
+    """
+    def __init__(self, debuglevel: int = 0, context: typing.Optional[ssl.SSLContext] = None, check_hostname=None):
+        super().__init__(debuglevel, context if context is not None else ssl.create_default_context(), check_hostname)
+
+
+class ConditionalCacheHandler(request.BaseHandler):
+    """
+    Persistent HTTP response cache driven by ETag / Last-Modified revalidation
+    Only requests whose "cacheable" attribute is set are looked up or stored, so archive downloads pass straight through
+    A "304 Not Modified" answer is turned into a regular response whose body is read from the local copy
+    """
+    # run before HTTPErrorProcessor so 200 responses are stored before anyone else consumes them
+    handler_order = 900
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def _paths(self, url: str) -> typing.Tuple[str, str]:
+        key = sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json'), os.path.join(self.cache_dir, key + '.body')
+
+    def _load(self, url: str) -> typing.Optional[dict]:
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, 'r') as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url or not os.path.isfile(body_path):
+            return None
+        return meta
+
+    def _cached_response(self, url: str, meta: dict) -> request.addinfourl:
+        _, body_path = self._paths(url)
+        with open(body_path, 'rb') as fp:
+            body = fp.read()
+        headers = HTTPMessage()
+        for name, value in meta.get('headers', {}).items():
+            headers[name] = value
+        response = request.addinfourl(BytesIO(body), headers, url, 200)
+        response.msg = 'OK'
+        response.from_cache = True
+        return response
+
+    def http_request(self, req: request.Request) -> request.Request:
+        if getattr(req, 'cacheable', False):
+            meta = self._load(req.full_url)
+            if meta is not None:
+                if meta.get('etag'):
+                    req.add_unredirected_header('If-None-Match', meta['etag'])
+                if meta.get('last_modified'):
+                    req.add_unredirected_header('If-Modified-Since', meta['last_modified'])
+        return req
+
+    https_request = http_request
+
+    def http_response(self, req: request.Request, response):
+        if not getattr(req, 'cacheable', False) or response.code != 200:
+            return response
+        timings.cache('http', hit=False)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return response
+        body = response.read()
+        response.close()
+        url = response.geturl()
+        meta = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'headers': {name: value for name, value in response.headers.items()
+                        if name.lower() in ('content-type', 'etag', 'last-modified')},
+        }
+        meta_path, body_path = self._paths(url)
+        atomic_write(body_path, body)
+        atomic_write(meta_path, json.dumps(meta).encode('utf-8'))
+        cached = request.addinfourl(BytesIO(body), response.headers, url, response.code)
+        cached.msg = response.msg
+        cached.from_cache = False
+        return cached
+
+    https_response = http_response
+
+    # noinspection PyUnusedLocal
+    def http_error_304(self, req: request.Request, fp, code, msg, hdrs):
+        meta = self._load(req.full_url)
+        if meta is None:
+            return None
+        fp.close()
+        timings.cache('http', hit=True)
+        return self._cached_response(req.full_url, meta)
+
+
+class _RedirectHandler(request.HTTPRedirectHandler):
+    """
+    HTTPRedirectHandler that carries the "cacheable" marker over to the redirected request
+    """
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new_req = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if new_req is not None:
+            new_req.cacheable = getattr(req, 'cacheable', False)
+        return new_req
 
 
 def make_request(url: str,
-                 method: typing.Optional[str] = 'GET') -> typing.Tuple[request.OpenerDirector, request.Request]:
+                 method: typing.Optional[str] = 'GET',
+                 cache_dir: typing.Optional[str] = None,
+                 cacheable: bool = False,
+                 pool: typing.Optional[ConnectionPool] = default_pool) -> typing.Tuple[request.OpenerDirector,
+                                                                                       request.Request]:
     """
     Creates a request and an opener to run it
     :param url: Initial URL for request
     :param method: HTTP Method for request
+    :param cache_dir: Directory for the conditional-request response cache, or None to disable it
+    :param cacheable: Whether the initial request may be served from / stored in the response cache
+    :param pool: ConnectionPool whose keep-alive connections are reused, or None to open one connection per request
     :return: tuple containing the OpenerDirector instance and the Request object
     """
-    rdh = request.HTTPRedirectHandler()
+    rdh = _RedirectHandler()
     rdh.max_repeats = 999
     rdh.max_redirections = 999
 
     cj = CookieJar()
     cjh = request.HTTPCookieProcessor(cj)
 
-    opener = request.build_opener(
-        rdh,
-        cjh
-    )
+    handlers = [rdh, cjh]
+    if pool is not None:
+        http_handler = KeepAliveHTTPHandler()
+        https_handler = KeepAliveHTTPSHandler()
+        http_handler.pool = https_handler.pool = pool
+        handlers.extend([http_handler, https_handler])
+    if cache_dir is not None:
+        handlers.append(ConditionalCacheHandler(cache_dir))
 
-    return opener, request.Request(url, method=method)
+    opener = request.build_opener(*handlers)
+
+    req = request.Request(url, method=method)
+    req.cacheable = cacheable
+    return opener, req
 
 
 def reset_request(request_obj: request.Request,
                   new_uri: str,
                   new_method: str = None,
-                  new_data: typing.Optional[typing.ByteString] = b'`^NO CHANGE^`') -> None:
+                  new_data: typing.Optional[typing.ByteString] = b'`^NO CHANGE^`',
+                  cacheable: typing.Optional[bool] = None) -> None:
     """
     Resets a urllib.request.Request instance URI
     Default value of new_data chosen because it contains characters that are not allowed per RFC 3986
@@ -52,10 +327,13 @@ def reset_request(request_obj: request.Request,
     :param new_uri: str - String containing the new URI
     :param new_method: str - String containing the new request method
     :param new_data: byte string - data to be sent alongside the request
+    :param cacheable: bool - whether the response cache may be used for the new URI; None leaves it unchanged
     :rtype: None
     """
     if new_method is not None:
         request_obj.method = new_method
+    if cacheable is not None:
+        request_obj.cacheable = cacheable
     if new_data != b'`^NO CHANGE^`':
         request_obj.data = new_data
     request_obj.full_url = new_uri
@@ -64,3 +342,22 @@ def reset_request(request_obj: request.Request,
     request_obj.fragment = result.fragment
     request_obj.origin_req_host = request_obj.host
     request_obj.unredirected_hdrs = dict()
+
+
+def fetch(opener: request.OpenerDirector,
+          url: str,
+          method: str = 'GET',
+          cacheable: bool = True) -> bytes:
+    """
+    Runs a fresh request through an existing opener and returns the whole body
+    Unlike reset_request, no Request object is shared, so several fetches may run concurrently on one opener
+    :param opener: OpenerDirector used to run the request
+    :param url: str - URL to retrieve
+    :param method: str - HTTP method for the request
+    :param cacheable: bool - whether the response cache may be used for this URL
+    :return: response body
+    """
+    req = request.Request(url, method=method)
+    req.cacheable = cacheable
+    with opener.open(req) as conn:
+        return conn.read()
@@ -0,0 +1,121 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+The repository location and layout are derived from SdkRepoConstants.java. They change perhaps once a year, so the
+resolved settings are kept in the cache directory together with a hash of the source they were parsed from.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+import typing
+from base64 import b64encode
+from util.fileutil import atomic_write
+from util.javafmtstr import pythonify_java_format_string, java_format_string_regex
+
+
+def make_rxstr() -> str:
+    rxstr = r''
+    sf = r'static[ \t]+final[ \t]+'
+    psf = r'^[ \t]*public[ \t]+' + sf
+    psfs = psf + r'string[ \t]+'
+    rsfs = r'^[ \t]*private[ \t]+' + sf + r'string[ \t]+'
+    endl = r'[ \t]*$'
+    nn1 = r'[ \t]+//\$NON-NLS-1\$' + endl
+    # URL_GOOGLE_SDK_SITE Variable
+    rxstr += psfs + r'URL_GOOGLE_SDK_SITE[ \t\r\n]*=[ \t\r\n]*[\'"](?P<URL_GOOGLE_SDK_SITE>.*?)[\'"];' + nn1 + r'|'
+    # NS_LATEST_VERSION Variable
+    rxstr += psf + r'int[ \t]+NS_LATEST_VERSION[ \t\r\n]*=[ \t\r\n]*(?P<NS_LATEST_VERSION>.*?);' + endl + r'|'
+    # URL_FILENAME_PATTERN Variable
+    rxstr += psfs + r'URL_FILENAME_PATTERN[ \t\r\n]*=[ \t\r\n]*[\'"](?P<URL_FILENAME_PATTERN>.*?)[\'"];' + nn1 + r'|'
+    # NS_BASE Variable
+    rxstr += rsfs + r'NS_BASE[ \t\r\n]*=[ \t\r\n]*[\'"](?P<NS_BASE>.*?)[\'"];' + nn1 + r'|'
+    # NS_PATTERN Variable
+    rxstr += psfs + r'NS_PATTERN[ \t\r\n]*=[ \t\r\n]*(?P<NS_PATTERN>.*?);' + nn1 + r'|'
+    # NS_URI Variable
+    rxstr += psfs + r'NS_URI[ \t\r\n]*=[ \t\r\n]*(?P<NS_URI>.*?);' + endl + r'|'
+    # NODE_SDK_REPOSITORY Variable
+    rxstr += psfs + r'NODE_SDK_REPOSITORY[ \t\r\n]*=[ \t\r\n]*[\'"](?P<NODE_SDK_REPOSITORY>.*?)[\'"];' + nn1 + r'|'
+    # NODE_PLATFORM_TOOL Variable
+    rxstr += psfs + r'NODE_PLATFORM_TOOL[ \t\r\n]*=[ \t\r\n]*[\'"](?P<NODE_PLATFORM_TOOL>.*?)[\'"];' + nn1 + r'|'
+    # GETSCHEMAURI Variable
+    rxstr += r'^[ \t]*(?P<GETSCHEMAURI>public[ \t]+static[ \t]+string[ \t]+getSchemaUri\([^)]*\)[ \t]*\{.*?\})[ \t\r\n]'
+    rxstr += r'*$'
+    return rxstr
+
+
+def parse_constants(source_text: str) -> typing.Dict[str, str]:
+    """
+    Extracts the repository settings from the text of SdkRepoConstants.java
+    :param source_text: str - Java source
+    :return: dict of settings, with NS_PATTERN and XMLNS resolved and URL_FILENAME_PATTERN in '{}'.format() syntax
+    """
+    rx = re.compile(make_rxstr(), re.MULTILINE + re.IGNORECASE + re.VERBOSE + re.UNICODE + re.DOTALL)
+
+    settings = dict()
+    for match in rx.finditer(source_text):
+        settings.update({key: val for key, val in match.groupdict().items() if val is not None})
+
+    if settings['NS_PATTERN'].startswith('NS_BASE + '):
+        settings['NS_PATTERN'] = settings['NS_BASE'] + settings['NS_PATTERN'][10:].replace('"', '')
+
+    if b64encode(settings['GETSCHEMAURI'].encode('utf-8')) == (b'cHVibGljIHN0YXRpYyBTdHJpbmcgZ2V0U2NoZW1hVXJpKGludCB2ZX'
+                                                               b'JzaW9uKSB7CiAgICAgICAgcmV0dXJuIFN0cmluZy5mb3JtYXQoTlNf'
+                                                               b'QkFTRSArICIlZCIsIHZlcnNpb24pOyAgICAgICAgICAgLy8kTk9OLU'
+                                                               b'5MUy0xJAogICAgfQ=='):
+        if b64encode(settings['NS_URI'].encode('utf-8')) == b'Z2V0U2NoZW1hVXJpKE5TX0xBVEVTVF9WRVJTSU9OKQ==':
+            settings['XMLNS'] = settings['NS_BASE'] + settings['NS_LATEST_VERSION']
+
+    settings['URL_FILENAME_PATTERN'], num_replacements = java_format_string_regex.subn(
+        pythonify_java_format_string, settings['URL_FILENAME_PATTERN'])
+    return settings
+
+
+def source_hash(source_data: bytes) -> str:
+    return hashlib.sha1(source_data).hexdigest()
+
+
+def _cache_path(cache_dir: str, url: str) -> str:
+    return os.path.join(cache_dir, 'bootstrap-{}.json'.format(hashlib.sha1(url.encode('utf-8')).hexdigest()))
+
+
+def read_cached_settings(cache_dir: str, url: str) -> typing.Optional[dict]:
+    """
+    Loads the settings last resolved from the constants at url
+    :param cache_dir: str - cache directory
+    :param url: str - URL the constants are read from
+    :return: dict with 'settings', 'source_sha1' and 'checked_at' (time of the last fetch), or None
+    """
+    try:
+        with open(_cache_path(cache_dir, url), 'r') as fp:
+            cached = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    return cached if cached.get('url') == url else None
+
+
+def write_cached_settings(cache_dir: str, url: str, source_sha1: str, settings: typing.Dict[str, str]) -> None:
+    """
+    Stores resolved settings along with the hash of the constants they came from
+    :param cache_dir: str - cache directory
+    :param url: str - URL the constants were read from
+    :param source_sha1: str - hash of the constants, see source_hash
+    :param settings: dict - settings as returned by parse_constants
+    :rtype: None
+    """
+    cached = {'url': url, 'source_sha1': source_sha1, 'checked_at': time.time(), 'settings': settings}
+    atomic_write(_cache_path(cache_dir, url), json.dumps(cached, sort_keys=True).encode('utf-8'))
@@ -0,0 +1,91 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import os
+import pathlib
+import typing
+from base64 import b64decode
+from urllib import parse
+from util.mirror import CONSTANTS_NAME
+
+GITILES_REPOSITORY_URL = 'https://android.googlesource.com/platform/tools/base/+/master/sdklib/src/main/java/com/' \
+                         'android/sdklib/repository/'
+
+
+class RepositorySource(object):
+    """
+    Location the bootstrap constants, the repository XML, its XSD and the archives are read from
+    Without a base URL this is Google's live setup: constants and XSD come base64-encoded from gitiles, repository and
+    archives from URL_GOOGLE_SDK_SITE. With one, everything is read from a tree laid out by --mirror, be it a local
+    directory, a file:// URL or an HTTP(S) mirror.
+    """
+    def __init__(self, base_url: typing.Optional[str] = None):
+        self.base_url = base_url
+
+    @property
+    def constants_url(self) -> str:
+        if self.base_url is None:
+            return GITILES_REPOSITORY_URL + CONSTANTS_NAME + '?format=TEXT'
+        return self.base_url + CONSTANTS_NAME
+
+    def decode(self, data: bytes) -> bytes:
+        """
+        gitiles serves file contents base64-encoded, mirrors store them as they are
+        :param data: bytes - body of a constants or XSD request
+        :return: the file contents
+        """
+        return b64decode(data) if self.base_url is None else data
+
+    def site_url(self, settings: dict) -> str:
+        return settings['URL_GOOGLE_SDK_SITE'] if self.base_url is None else self.base_url
+
+    def repository_url(self, settings: dict) -> str:
+        return self.site_url(settings) + settings['URL_FILENAME_PATTERN'].format(int(settings['NS_LATEST_VERSION']))
+
+    def xsd_url(self, settings: dict) -> str:
+        name = '{}-{}.xsd'.format(settings['NODE_SDK_REPOSITORY'], settings['NS_LATEST_VERSION'])
+        if self.base_url is None:
+            return GITILES_REPOSITORY_URL + name + '?format=TEXT'
+        return self.base_url + name
+
+    def archive_url(self, settings: dict, url: str) -> str:
+        """
+        Resolves an archive URL from the repository XML
+        Relative URLs are relative to the site; absolute ones below URL_GOOGLE_SDK_SITE are taken from the mirror too
+        :param settings: dict - resolved bootstrap settings
+        :param url: str - archive URL as given in the repository
+        :return: absolute URL to download the archive from
+        """
+        if not url.lower().startswith('http'):
+            return self.site_url(settings) + url
+        if self.base_url is not None and url.startswith(settings['URL_GOOGLE_SDK_SITE']):
+            return self.base_url + url[len(settings['URL_GOOGLE_SDK_SITE']):]
+        return url
+
+
+def repository_source(location: typing.Optional[str]) -> RepositorySource:
+    """
+    Creates the repository source for a configured location
+    :param location: str - mirror directory, file:// URL or HTTP(S) URL; None or empty for Google's live endpoints
+    :rtype: RepositorySource
+    """
+    if not location:
+        return RepositorySource()
+    if parse.urlparse(location).scheme.lower() in ('file', 'http', 'https'):
+        base_url = location
+    else:
+        base_url = pathlib.Path(os.path.expanduser(location)).resolve().as_uri()
+    return RepositorySource(base_url if base_url.endswith('/') else base_url + '/')
@@ -0,0 +1,171 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Staged installations keep every version in its own directory below "<base>/versions" and expose the active one as
+"<base>/current". Switching versions is a single atomic symlink replacement; where symlinks are unavailable the
+active directory is swapped in by rename instead.
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+import typing
+from util.fileutil import atomic_write
+
+VERSIONS_DIR = 'versions'
+CURRENT_LINK = 'current'
+HISTORY_NAME = '.history.json'
+STAGE_MARKER = '.nsaptr-stage'
+
+
+def _versions_dir(base_dir: str) -> str:
+    return os.path.join(base_dir, VERSIONS_DIR)
+
+
+def _read_history(base_dir: str) -> typing.List[str]:
+    try:
+        with open(os.path.join(_versions_dir(base_dir), HISTORY_NAME), 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return []
+
+
+def _write_history(base_dir: str, history: typing.List[str]) -> None:
+    atomic_write(os.path.join(_versions_dir(base_dir), HISTORY_NAME), json.dumps(history).encode('utf-8'))
+
+
+def current_name(base_dir: str) -> typing.Optional[str]:
+    """
+    Tells which staged version is active
+    :param base_dir: str - installation base directory
+    :return: name of the active version directory, or None if nothing has been activated yet
+    """
+    link = os.path.join(base_dir, CURRENT_LINK)
+    if os.path.islink(link):
+        return os.path.basename(os.path.normpath(os.readlink(link)))
+    try:
+        with open(os.path.join(link, STAGE_MARKER), 'r') as fp:
+            return fp.read().strip()
+    except OSError:
+        return None
+
+
+def create_stage(base_dir: str) -> str:
+    """
+    Creates an empty directory to extract a new version into, next to the installed versions
+    :param base_dir: str - installation base directory
+    :return: path of the staging directory
+    """
+    os.makedirs(_versions_dir(base_dir), exist_ok=True)
+    return tempfile.mkdtemp(prefix='.staging-', dir=_versions_dir(base_dir))
+
+
+def activate(base_dir: str, name: str) -> None:
+    """
+    Makes a version directory the active one
+    :param base_dir: str - installation base directory
+    :param name: str - name of a directory below "<base>/versions"
+    :rtype: None
+    """
+    link = os.path.join(base_dir, CURRENT_LINK)
+    target = os.path.join(_versions_dir(base_dir), name)
+    if not os.path.isdir(target):
+        raise FileNotFoundError('No staged version named {}'.format(name))
+    temp_link = os.path.join(base_dir, '.{}.tmp'.format(CURRENT_LINK))
+    if os.path.lexists(temp_link):
+        os.remove(temp_link)
+    if not os.path.exists(link) or os.path.islink(link):
+        try:
+            os.symlink(os.path.join(VERSIONS_DIR, name), temp_link, target_is_directory=True)
+        except (OSError, NotImplementedError):
+            if os.path.lexists(link):
+                raise
+        else:
+            os.replace(temp_link, link)
+            return
+    # no symlinks available: "current" is a real directory, move it back among the versions and rename in the new one
+    previous = current_name(base_dir)
+    if os.path.isdir(link):
+        if previous is None:
+            raise FileExistsError('{} is not a staged installation'.format(link))
+        os.rename(link, os.path.join(_versions_dir(base_dir), previous))
+    os.rename(target, link)
+
+
+def publish_stage(base_dir: str, stage_path: str, version: str) -> str:
+    """
+    Turns a fully extracted staging directory into a version directory and activates it
+    :param base_dir: str - installation base directory
+    :param stage_path: str - directory returned by create_stage
+    :param version: str - version installed in the staging directory
+    :return: name of the new version directory
+    """
+    name = '{}-{}'.format(version, time.strftime('%Y%m%d%H%M%S'))
+    suffix = 0
+    while os.path.exists(os.path.join(_versions_dir(base_dir), name + ('.{}'.format(suffix) if suffix else ''))):
+        suffix += 1
+    name += '.{}'.format(suffix) if suffix else ''
+    with open(os.path.join(stage_path, STAGE_MARKER), 'w') as fp:
+        fp.write(name)
+    os.rename(stage_path, os.path.join(_versions_dir(base_dir), name))
+    activate(base_dir, name)
+    history = [x for x in _read_history(base_dir) if x != name]
+    history.append(name)
+    _write_history(base_dir, history)
+    return name
+
+
+def rollback(base_dir: str) -> str:
+    """
+    Re-activates the version that was active before the current one
+    :param base_dir: str - installation base directory
+    :return: name of the version that is now active
+    """
+    active = current_name(base_dir)
+    history = _read_history(base_dir)
+    candidates = [x for x in history if x != active and
+                  (os.path.isdir(os.path.join(_versions_dir(base_dir), x)))]
+    if not candidates:
+        raise FileNotFoundError('No previous version to roll back to')
+    name = candidates[-1]
+    activate(base_dir, name)
+    history = [x for x in history if x != name]
+    history.append(name)
+    _write_history(base_dir, history)
+    return name
+
+
+def prune(base_dir: str, keep: int) -> typing.List[str]:
+    """
+    Removes old version directories, keeping the active one and the "keep" most recently active others
+    Leftover staging directories from interrupted installs are removed as well
+    :param base_dir: str - installation base directory
+    :param keep: int - number of inactive versions to keep for rollback
+    :return: names of the removed directories
+    """
+    active = current_name(base_dir)
+    history = [x for x in _read_history(base_dir) if x != active]
+    keep_names = set(history[-keep:] if keep > 0 else []) | {active}
+    removed = []
+    for name in os.listdir(_versions_dir(base_dir)):
+        path = os.path.join(_versions_dir(base_dir), name)
+        if name in keep_names or not os.path.isdir(path) or os.path.islink(path):
+            continue
+        shutil.rmtree(path)
+        removed.append(name)
+    _write_history(base_dir, [x for x in _read_history(base_dir) if x not in removed])
+    return removed
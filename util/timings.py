@@ -0,0 +1,170 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Run instrumentation: wall time, CPU time and bytes per phase, plus request and cache hit / miss counters, written out
+as one JSON record per run. Everything is a no-op until the recorder is enabled.
+
+Phases are accumulated by name and may nest (the transfer phase includes the hashing of what was received). Their CPU
+time is that of the whole process while the phase ran, so phases running concurrently share it; hashing is measured
+per chunk on the calling thread instead, since it happens inside the transfers of several threads at once.
+"""
+import contextlib
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import typing
+
+RECORD_VERSION = 1
+
+
+class Timings(object):
+    """
+    Thread-safe accumulator of phase timings and counters
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._phases = dict()
+        self._counters = dict()
+        self._caches = dict()
+        self._started_at = time.time()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    def _phase_entry(self, name: str) -> dict:
+        return self._phases.setdefault(name, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'bytes': 0})
+
+    def add(self, name: str, wall_time: float, cpu_time: float, nbytes: int = 0) -> None:
+        """
+        Adds one measurement to a phase
+        :param name: str - phase name
+        :param wall_time: float - elapsed seconds
+        :param cpu_time: float - CPU seconds
+        :param nbytes: int - bytes processed
+        :rtype: None
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            phase = self._phase_entry(name)
+            phase['calls'] += 1
+            phase['wall_time'] += wall_time
+            phase['cpu_time'] += cpu_time
+            phase['bytes'] += nbytes
+
+    def add_bytes(self, name: str, nbytes: int) -> None:
+        """
+        Credits bytes to a phase without counting another call, for sizes only known once the phase has ended
+        :param name: str - phase name
+        :param nbytes: int - bytes processed
+        :rtype: None
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._phase_entry(name)['bytes'] += nbytes
+
+    @contextlib.contextmanager
+    def phase(self, name: str, nbytes: int = 0) -> typing.Iterator[None]:
+        """
+        Measures the enclosed block as one call of a phase
+        :param name: str - phase name
+        :param nbytes: int - bytes processed, if known up front (see add_bytes)
+        """
+        if not self.enabled:
+            yield
+            return
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall_start, time.process_time() - cpu_start, nbytes)
+
+    def hash_update(self, hasher, data: bytes) -> None:
+        """
+        Feeds a hasher, crediting the time to the "verify_<algorithm>" phase
+        :param hasher: hashlib object
+        :param data: bytes - chunk to hash
+        :rtype: None
+        """
+        if not self.enabled:
+            hasher.update(data)
+            return
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        hasher.update(data)
+        # every chunk counts as a call of its own
+        self.add('verify_' + hasher.name, time.perf_counter() - wall_start, time.thread_time() - cpu_start, len(data))
+
+    def count(self, name: str, increment: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + increment
+
+    def cache(self, name: str, hit: bool) -> None:
+        """
+        Counts a lookup in one of the caches
+        :param name: str - cache name
+        :param hit: bool - whether the lookup was answered from the cache
+        :rtype: None
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            cache = self._caches.setdefault(name, {'hits': 0, 'misses': 0})
+            cache['hits' if hit else 'misses'] += 1
+
+    def record(self) -> dict:
+        """
+        Builds the JSON record of the run so far
+        :return: dict ready for json.dumps
+        """
+        with self._lock:
+            return {
+                'record_version': RECORD_VERSION,
+                'started_at': self._started_at,
+                'wall_time': time.perf_counter() - self._wall_start,
+                'cpu_time': time.process_time() - self._cpu_start,
+                'argv': sys.argv[1:],
+                'platform': platform.system(),
+                'python': platform.python_version(),
+                'phases': {name: dict(values) for name, values in self._phases.items()},
+                'counters': dict(self._counters),
+                'caches': {name: dict(values) for name, values in self._caches.items()},
+            }
+
+    def write(self, destination: typing.Optional[str]) -> None:
+        """
+        Writes the record as a single line of JSON
+        Files are appended to, so one file can collect the records of many runs
+        :param destination: str - file name, or None / '-' for stderr
+        :rtype: None
+        """
+        line = json.dumps(self.record(), sort_keys=True) + '\n'
+        if destination is None or destination == '-':
+            sys.stderr.write(line)
+            sys.stderr.flush()
+            return
+        with open(os.path.expanduser(destination), 'a') as fp:
+            fp.write(line)
+
+
+timings = Timings()
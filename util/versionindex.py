@@ -0,0 +1,177 @@
+"""
+NSAptr - a Non-Sketchy Android Platform Tools Retriever
+Copyright 2016 adpoliak
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+The version index holds every platform-tool revision of a repository document: its numeric version, its license and
+its archive for each host OS. It is stored in the cache directory next to the SHA-1 of the document it was built from,
+so the XML is only parsed (and validated) again once the repository actually changes.
+"""
+import hashlib
+import json
+import os
+import typing
+from util.fileutil import atomic_write
+
+INDEX_VERSION = 1
+# key of archives that do not name a host OS; they serve every host without an archive of its own
+ANY_HOST = ''
+
+
+def version_key(version: str) -> typing.Tuple[typing.Tuple[int, ...], str]:
+    """
+    Sort key for version strings such as '24.0.1', numeric part by part
+    A ':KEEP' (or any other) suffix sorts right after the plain version
+    :param version: str - version string, optionally followed by ':' and a suffix
+    :return: tuple of the numeric parts and the suffix
+    """
+    base, _, suffix = version.partition(':')
+    return tuple(int(part) if part.isdigit() else 0 for part in base.split('.')), suffix
+
+
+def _index_path(cache_dir: str, url: str) -> str:
+    return os.path.join(cache_dir, 'versions-{}.json'.format(hashlib.sha1(url.encode('utf-8')).hexdigest()))
+
+
+class VersionIndex(object):
+    """
+    Queryable list of platform-tool revisions, ordered from oldest to newest
+    """
+    def __init__(self,
+                 revisions: typing.List[dict],
+                 licenses: typing.Dict[str, str],
+                 source_sha1: typing.Optional[str] = None,
+                 validated: bool = False):
+        """
+        :param revisions: list of {'version', 'revision', 'license', 'archives'} dicts, 'archives' being
+            {host_os: {'size', 'checksum', 'url'}}
+        :param licenses: dict - license texts keyed by license id
+        :param source_sha1: str - SHA-1 of the repository document the revisions were read from
+        :param validated: bool - whether that document passed schema validation
+        """
+        self.revisions = sorted(revisions, key=lambda x: tuple(x['revision']))
+        self.licenses = licenses
+        self.source_sha1 = source_sha1
+        self.validated = validated
+        self._by_version = {x['version']: x for x in self.revisions}
+
+    @classmethod
+    def from_records(cls,
+                     records: typing.List[dict],
+                     licenses: typing.Dict[str, str],
+                     source_sha1: typing.Optional[str] = None,
+                     validated: bool = False) -> 'VersionIndex':
+        """
+        Builds an index from the output of parse_repository
+        Only the first archive listed for each host OS is kept, as the installer would only ever use that one
+        """
+        revisions = []
+        for record in records:
+            archives = dict()
+            for archive in record['archives']:
+                archives.setdefault(archive['host_os'] or ANY_HOST, {
+                    'size': archive['size'],
+                    'checksum': archive['checksum'],
+                    'url': archive['url'],
+                })
+            revisions.append({
+                'version': record['version'],
+                'revision': list(record['revision']),
+                'license': record['license'],
+                'archives': archives,
+            })
+        return cls(revisions, licenses, source_sha1, validated)
+
+    def __contains__(self, version: str) -> bool:
+        return version in self._by_version
+
+    def versions(self, host_os: typing.Optional[str] = None,
+                 license_id: typing.Optional[str] = None) -> typing.List[str]:
+        """
+        Lists versions from oldest to newest
+        :param host_os: str - only versions with an archive for this host OS, or None for all
+        :param license_id: str - only versions distributed under this license, or None for all
+        :return: list of version strings
+        """
+        return [x['version'] for x in self.revisions
+                if (host_os is None or host_os in x['archives'] or ANY_HOST in x['archives']) and
+                (license_id is None or x['license'] == license_id)]
+
+    def latest(self, host_os: typing.Optional[str] = None,
+               license_id: typing.Optional[str] = None) -> typing.Optional[str]:
+        """
+        :return: the newest version matching the filters of versions(), or None if there is none
+        """
+        versions = self.versions(host_os, license_id)
+        return versions[-1] if versions else None
+
+    def license_id(self, version: str) -> typing.Optional[str]:
+        return self._by_version[version]['license'] if version in self._by_version else None
+
+    def archive(self, version: str, host_os: str) -> typing.Optional[dict]:
+        """
+        :return: {'size', 'checksum', 'url'} of a version's archive for a host OS, or None if it has none
+        """
+        revision = self._by_version.get(version)
+        if revision is None:
+            return None
+        return revision['archives'].get(host_os, revision['archives'].get(ANY_HOST))
+
+    def host_archives(self, host_os: str) -> typing.Dict[str, dict]:
+        """
+        Collects what installing on one host needs
+        :param host_os: str - repository host-os name
+        :return: dict of {'size', 'checksum', 'url', 'license'} keyed by version, oldest first
+        """
+        archives = dict()
+        for version in self.versions(host_os):
+            archives[version] = dict(self.archive(version, host_os), license=self.license_id(version))
+        return archives
+
+    def all_archives(self) -> typing.Iterator[typing.Tuple[str, str, dict]]:
+        """
+        :return: iterator over (version, host_os, archive) for every archive of every version
+        """
+        for revision in self.revisions:
+            for host_os, archive in sorted(revision['archives'].items()):
+                yield revision['version'], host_os, archive
+
+    @classmethod
+    def load(cls, cache_dir: str, url: str) -> typing.Optional['VersionIndex']:
+        """
+        Reads the index stored for a repository URL
+        :param cache_dir: str - cache directory
+        :param url: str - repository XML URL
+        :return: the index, or None if there is none (or it is unreadable or from another format version)
+        """
+        try:
+            with open(_index_path(cache_dir, url), 'r') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if data.get('index_version') != INDEX_VERSION or data.get('url') != url:
+            return None
+        return cls(data['revisions'], data['licenses'], data['source_sha1'], data['validated'])
+
+    def save(self, cache_dir: str, url: str) -> None:
+        data = {
+            'index_version': INDEX_VERSION,
+            'url': url,
+            'source_sha1': self.source_sha1,
+            'validated': self.validated,
+            'licenses': self.licenses,
+            'revisions': self.revisions,
+        }
+        atomic_write(_index_path(cache_dir, url),
+                     json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8'))
@@ -30,6 +30,11 @@ For original code contained in this file, the following applies:
 """
 import os
 import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import *
 
 # Enum choices for ZipFileMod.extractall preserve_permissions argument
@@ -43,9 +48,10 @@ class ZipFileMod(ZipFile):
     def _RealGetContents(self):
         return super()._RealGetContents()
 
-    def _extract_member(self, member, targetpath, pwd, preserve_permissions=PERMS_PRESERVE_NONE):
-        """Extract the ZipInfo object 'member' to a physical
-           file on the path targetpath.
+    @classmethod
+    def _member_path(cls, member, targetpath):
+        """Return the sanitised location of the ZipInfo object 'member'
+           below the directory targetpath.
         """
         # build the destination pathname, replacing
         # forward slashes to platform specific separators.
@@ -61,32 +67,99 @@ class ZipFileMod(ZipFile):
                                    if x not in invalid_path_parts)
         if os.path.sep == '\\':
             # filter illegal characters on Windows
-            arcname = self._sanitize_windows_name(arcname, os.path.sep)
+            arcname = cls._sanitize_windows_name(arcname, os.path.sep)
 
         targetpath = os.path.join(targetpath, arcname)
-        targetpath = os.path.normpath(targetpath)
+        return os.path.normpath(targetpath)
+
+    @staticmethod
+    def _apply_permissions(member, targetpath, preserve_permissions):
+        if preserve_permissions in [PERMS_PRESERVE_SAFE, PERMS_PRESERVE_ALL]:
+            bitmask = 0x1FF if preserve_permissions == PERMS_PRESERVE_SAFE else 0xFFF
+            mode = member.external_attr >> 16 & bitmask
+            os.chmod(targetpath, mode)
+
+    def _extract_member(self, member, targetpath, pwd, preserve_permissions=PERMS_PRESERVE_NONE):
+        """Extract the ZipInfo object 'member' to a physical
+           file on the path targetpath.
+        """
+        targetpath = self._member_path(member, targetpath)
 
         # Create all upper directories if necessary.
         upperdirs = os.path.dirname(targetpath)
         if upperdirs and not os.path.exists(upperdirs):
-            os.makedirs(upperdirs)
+            # another extraction worker may be creating the same directory
+            os.makedirs(upperdirs, exist_ok=True)
 
         if member.filename[-1] == '/':
             if not os.path.isdir(targetpath):
                 os.mkdir(targetpath)
             return targetpath
 
+        # never write through a hard link into a file shared with another
+        # installation or the extracted store
+        if os.path.isfile(targetpath) and os.stat(targetpath).st_nlink > 1:
+            os.remove(targetpath)
+
         with self.open(member, pwd=pwd) as source, \
                 open(targetpath, "wb") as target:
             shutil.copyfileobj(source, target)
 
-        if preserve_permissions in [PERMS_PRESERVE_SAFE, PERMS_PRESERVE_ALL]:
-            bitmask = 0x1FF if preserve_permissions == PERMS_PRESERVE_SAFE else 0xFFF
-            mode = member.external_attr >> 16 & bitmask
-            os.chmod(targetpath, mode)
+        self._apply_permissions(member, targetpath, preserve_permissions)
 
         return targetpath
 
+    def member_manifest(self):
+        """Return a dict describing every file member by the size and
+           CRC32 recorded in the central directory, keyed by member name.
+           This is the form accepted by extractall's `manifest' argument.
+        """
+        return {info.filename: {'size': info.file_size, 'crc32': info.CRC}
+                for info in self.infolist() if info.filename[-1] != '/'}
+
+    def _member_unchanged(self, member, path, manifest=None):
+        """Tell whether the file member already exists under path with
+           the same content. A manifest entry matching the member's size
+           and CRC32 is trusted as long as the on-disk size agrees;
+           otherwise the on-disk file is checksummed.
+        """
+        targetpath = self._member_path(member, path)
+        try:
+            on_disk_size = os.stat(targetpath).st_size
+        except OSError:
+            return False
+        if on_disk_size != member.file_size:
+            return False
+        recorded = (manifest or {}).get(member.filename)
+        if recorded is not None and recorded.get('size') == member.file_size and \
+                recorded.get('crc32') == member.CRC:
+            return True
+        crc = 0
+        with open(targetpath, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(64 * 1024), b''):
+                crc = zlib.crc32(chunk, crc)
+        return crc == member.CRC
+
+    def _remove_stale(self, path, manifest):
+        """Delete files listed in a previous manifest that are no longer
+           part of this archive, along with directories left empty.
+        """
+        current = set(self.namelist())
+        directories = set()
+        for name in manifest:
+            if name in current:
+                continue
+            targetpath = self._member_path(ZipInfo(name), path)
+            if os.path.isfile(targetpath):
+                os.remove(targetpath)
+            directories.add(os.path.dirname(targetpath))
+        root = os.path.normpath(path)
+        for directory in sorted(directories, key=len, reverse=True):
+            while directory.startswith(root + os.path.sep) and os.path.isdir(directory) and \
+                    not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+
     def extract(self, member, path=None, pwd=None,
                 preserve_permissions=PERMS_PRESERVE_NONE):
         """Extract a member from the archive to the current working directory,
@@ -102,8 +175,24 @@ class ZipFileMod(ZipFile):
 
         return self._extract_member(member, path, pwd, preserve_permissions)
 
+    def _worker_handle(self, local, handles, lock):
+        """Return the archive handle the calling extraction worker should
+           read from. Archives opened from a path get one independent
+           handle per worker; anything else is shared, relying on the
+           locking done by ZipFile's shared file wrapper.
+        """
+        if not isinstance(self.filename, str) or not os.path.isfile(self.filename):
+            return self
+        handle = getattr(local, 'handle', None)
+        if handle is None:
+            handle = local.handle = ZipFileMod(self.filename)
+            with lock:
+                handles.append(handle)
+        return handle
+
     def extractall(self, path=None, members=None, pwd=None,
-                   preserve_permissions=PERMS_PRESERVE_NONE):
+                   preserve_permissions=PERMS_PRESERVE_NONE, workers=1,
+                   incremental=False, manifest=None):
         """Extract all members from the archive to the current working
            directory. `path' specifies a different directory to extract to.
            `members' is optional and must be a subset of the list returned by
@@ -111,10 +200,291 @@ class ZipFileMod(ZipFile):
            zipped files are preserved or not. Default is PERMS_PRESERVE_NONE -
            do not preserve any permissions. Other options are to preserve safe
            subset of permissions PERMS_PRESERVE_SAFE or all permissions
-           PERMS_PRESERVE_ALL.
+           PERMS_PRESERVE_ALL. `workers' sets how many members are inflated
+           concurrently; directories are always created first.
+           With `incremental' set, files whose size and CRC32 already match
+           are left alone. `manifest' (see member_manifest) describes the
+           previous installation: its entries spare re-reading unchanged
+           files, and files it lists that are gone from this archive are
+           removed. Returns the list of members that were written.
         """
         if members is None:
             members = self.namelist()
+        if path is None:
+            path = os.getcwd()
+        members = [m if isinstance(m, ZipInfo) else self.getinfo(m) for m in members]
+
+        if incremental:
+            changed = []
+            for zipinfo in members:
+                if zipinfo.filename[-1] != '/' and self._member_unchanged(zipinfo, path, manifest):
+                    self._apply_permissions(zipinfo, self._member_path(zipinfo, path), preserve_permissions)
+                else:
+                    changed.append(zipinfo)
+            members = changed
+            if manifest:
+                self._remove_stale(path, manifest)
+
+        if workers <= 1:
+            for zipinfo in members:
+                self._extract_member(zipinfo, path, pwd, preserve_permissions)
+            return members
 
         for zipinfo in members:
-            self.extract(zipinfo, path, pwd, preserve_permissions)
+            if zipinfo.filename[-1] == '/':
+                self._extract_member(zipinfo, path, pwd, preserve_permissions)
+
+        local = threading.local()
+        handles = []
+        lock = threading.Lock()
+
+        def extract_file(member):
+            handle = self._worker_handle(local, handles, lock)
+            member = handle.getinfo(member.filename) if handle is not self else member
+            return handle._extract_member(member, path, pwd, preserve_permissions)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for _ in executor.map(extract_file, [m for m in members if m.filename[-1] != '/']):
+                    pass
+        finally:
+            for handle in handles:
+                handle.close()
+        return members
+
+
+class StreamingUnsupported(Exception):
+    """Raised by ZipStreamExtractor for a layout it cannot follow
+       without the central directory.
+    """
+
+
+class ZipStreamExtractor(object):
+    """Inflate the members of a ZIP archive from their local file headers
+       while the archive is still being received.
+
+       Bytes are handed over through feed() in archive order; every member
+       is written below a staging directory as soon as its data is
+       complete. Local headers carry no permission bits and may be
+       inconsistent with the central directory, so nothing is trusted
+       until publish() has compared each staged member with the central
+       directory of the complete archive.
+
+       Layouts that cannot be followed without the central directory
+       (encrypted members, stored members with a trailing data descriptor,
+       compression methods other than stored and deflate) and corrupt
+       member data make the extractor give up quietly: `usable' turns False, the staging area
+       is dropped and the caller is expected to fall back to extractall.
+    """
+    _LOCAL_HEADER = struct.Struct('<4sHHHHHLLLHH')
+    _LOCAL_SIGNATURE = b'PK\x03\x04'
+    _DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+    _TRAILER_SIGNATURES = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06', b'PK\x06\x07')
+
+    def __init__(self, staging_dir):
+        self.staging_dir = tempfile.mkdtemp(prefix='.nsaptr-pipeline-', dir=staging_dir)
+        self.members = {}
+        self.usable = True
+        self._buffer = bytearray()
+        self._member = None
+        self._in_trailer = False
+
+    @property
+    def complete(self):
+        """True once every member up to the central directory has been
+           staged without trouble.
+        """
+        return self.usable and self._member is None and self._in_trailer
+
+    def reset(self):
+        """Forget everything received so far; the archive is about to be
+           sent again from its first byte.
+        """
+        self.discard()
+        self.__init__(os.path.dirname(self.staging_dir))
+
+    def discard(self):
+        """Remove the staging area."""
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def feed(self, data):
+        """Process the next bytes of the archive."""
+        if not self.usable or self._in_trailer:
+            return
+        self._buffer += data
+        try:
+            while self._step():
+                pass
+        except (StreamingUnsupported, ValueError, zlib.error):
+            self.usable = False
+            if self._member is not None and self._member['target'] is not None:
+                self._member['target'].close()
+                self._member = None
+            self.discard()
+
+    def _start_member(self):
+        if len(self._buffer) < 4:
+            return False
+        signature = bytes(self._buffer[:4])
+        if signature in self._TRAILER_SIGNATURES:
+            self._in_trailer = True
+            self._buffer = bytearray()
+            return False
+        if signature != self._LOCAL_SIGNATURE:
+            raise StreamingUnsupported('Unexpected record signature {!r}'.format(signature))
+        if len(self._buffer) < self._LOCAL_HEADER.size:
+            return False
+        (_, _, flags, method, _, _, crc, compressed_size, file_size,
+         name_length, extra_length) = self._LOCAL_HEADER.unpack_from(self._buffer)
+        header_size = self._LOCAL_HEADER.size + name_length + extra_length
+        if len(self._buffer) < header_size:
+            return False
+        raw_name = bytes(self._buffer[self._LOCAL_HEADER.size:self._LOCAL_HEADER.size + name_length])
+        extra = bytes(self._buffer[self._LOCAL_HEADER.size + name_length:header_size])
+        del self._buffer[:header_size]
+
+        name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437')
+        zip64 = False
+        offset = 0
+        while offset + 4 <= len(extra):
+            tag, length = struct.unpack_from('<HH', extra, offset)
+            if tag == 0x0001:
+                zip64 = True
+                values = list(struct.unpack_from('<{}Q'.format(min(length // 8, 2)), extra, offset + 4))
+                if file_size == 0xFFFFFFFF and values:
+                    file_size = values.pop(0)
+                if compressed_size == 0xFFFFFFFF and values:
+                    compressed_size = values.pop(0)
+            offset += 4 + length
+
+        if flags & 0x1:
+            raise StreamingUnsupported('Encrypted members cannot be streamed')
+        if method not in (ZIP_STORED, ZIP_DEFLATED):
+            raise StreamingUnsupported('Compression method {} cannot be streamed'.format(method))
+        has_descriptor = bool(flags & 0x8)
+
+        if has_descriptor and method == ZIP_STORED and name[-1] != '/':
+            raise StreamingUnsupported('Stored members with data descriptors cannot be streamed')
+
+        targetpath = ZipFileMod._member_path(ZipInfo(name), self.staging_dir)
+        if name[-1] == '/':
+            # directory entries may still carry an (empty) data stream and a descriptor, which are skipped
+            os.makedirs(targetpath, exist_ok=True)
+            target = None
+        else:
+            os.makedirs(os.path.dirname(targetpath), exist_ok=True)
+            target = open(targetpath, 'wb')
+        self._member = {
+            'name': name,
+            'path': targetpath,
+            'target': target,
+            'descriptor': has_descriptor,
+            'zip64': zip64,
+            # a stored directory entry followed by a descriptor has no data at all
+            'remaining': 0 if target is None and method == ZIP_STORED else None if has_descriptor else compressed_size,
+            'decompressor': zlib.decompressobj(-15) if method == ZIP_DEFLATED else None,
+            'crc32': 0,
+            'size': 0,
+            'header_crc32': None if has_descriptor else crc,
+        }
+        return True
+
+    def _write(self, data):
+        member = self._member
+        member['crc32'] = zlib.crc32(data, member['crc32'])
+        member['size'] += len(data)
+        if member['target'] is not None:
+            member['target'].write(data)
+
+    def _finish_member(self, crc):
+        member = self._member
+        if member['target'] is not None:
+            member['target'].close()
+        if crc != member['crc32']:
+            raise ValueError('CRC mismatch in streamed member {}'.format(member['name']))
+        self.members[member['name']] = {'path': member['path'], 'crc32': member['crc32'], 'size': member['size']}
+        self._member = None
+
+    def _read_descriptor(self):
+        """Consume a data descriptor: optional signature, CRC-32 and both
+           sizes. Returns the CRC-32, or None if more bytes are needed.
+        """
+        signature_size = 4 if bytes(self._buffer[:4]) == self._DESCRIPTOR_SIGNATURE else 0
+        descriptor_size = signature_size + (20 if self._member['zip64'] else 12)
+        if len(self._buffer) < descriptor_size:
+            return None
+        crc = struct.unpack_from('<L', self._buffer, signature_size)[0]
+        del self._buffer[:descriptor_size]
+        return crc
+
+    def _step(self):
+        member = self._member
+        if member is None:
+            return self._start_member()
+        if member['remaining'] is not None:
+            # sizes known from the local header
+            if member['remaining']:
+                if not self._buffer:
+                    return False
+                chunk = bytes(self._buffer[:member['remaining']])
+                del self._buffer[:len(chunk)]
+                member['remaining'] -= len(chunk)
+                if member['decompressor'] is None:
+                    self._write(chunk)
+                else:
+                    self._write(member['decompressor'].decompress(chunk))
+                if member['remaining']:
+                    return False
+                if member['decompressor'] is not None:
+                    self._write(member['decompressor'].flush())
+            crc = member['header_crc32']
+            if member['descriptor']:
+                crc = self._read_descriptor()
+                if crc is None:
+                    return False
+            self._finish_member(crc)
+            return True
+        decompressor = member['decompressor']
+        if not decompressor.eof:
+            if not self._buffer:
+                return False
+            chunk = bytes(self._buffer)
+            self._buffer = bytearray()
+            self._write(decompressor.decompress(chunk))
+            if not decompressor.eof:
+                return False
+            self._buffer = bytearray(decompressor.unused_data)
+        crc = self._read_descriptor()
+        if crc is None:
+            return False
+        self._finish_member(crc)
+        return True
+
+    def publish(self, archive, path, preserve_permissions=PERMS_PRESERVE_NONE, manifest=None):
+        """Check every staged member against the central directory of the
+           complete `archive' (a ZipFileMod) and move them below `path',
+           applying permissions from the central directory. Files listed in
+           `manifest' that are no longer part of the archive are removed.
+           Nothing is moved unless every member checks out.
+        """
+        if not self.complete:
+            raise ValueError('Streamed extraction is incomplete')
+        infos = archive.infolist()
+        if len(infos) != len(self.members):
+            raise ValueError('Streamed members do not match the central directory')
+        for info in infos:
+            staged = self.members.get(info.filename)
+            if staged is None or (info.filename[-1] != '/' and
+                                  (staged['crc32'] != info.CRC or staged['size'] != info.file_size)):
+                raise ValueError('Streamed member {} does not match the central directory'.format(info.filename))
+        for info in infos:
+            targetpath = archive._member_path(info, path)
+            if info.filename[-1] == '/':
+                os.makedirs(targetpath, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(targetpath), exist_ok=True)
+            os.replace(self.members[info.filename]['path'], targetpath)
+            archive._apply_permissions(info, targetpath, preserve_permissions)
+        if manifest:
+            archive._remove_stale(path, manifest)
+        self.discard()